@@ -0,0 +1,157 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+from xml.sax.saxutils import escape
+import hashlib
+import os
+import re
+import threading
+import time
+
+LAST_MODIFIED = '2020-01-01T00:00:00.000Z'
+FILLER_PREFIX = 'filler/'
+
+# A local stand-in for a public S3 bucket: ListObjects v1 (marker) and v2 (continuation-token) pages of page_size keys,
+# prefix and delimiter, GET/HEAD with Range and If-Range support and an optional delay before every response. Keys are the files in
+# directory, plus filler_count small generated keys under filler/ that are only there to make the listing long.
+class FakeBucket():
+    def __init__(self, directory, filler_count=0, filler_size=1024):
+        super().__init__()
+        self.directory = directory
+        self.filler_size = filler_size
+        self.objects = {}
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                self.objects[os.path.relpath(path, directory).replace(os.sep, '/')] = path
+        for index in range(filler_count):
+            self.objects['{}{:07d}.txt'.format(FILLER_PREFIX, index)] = None
+        self.keys = sorted(self.objects.keys())
+        self.etags = {}
+
+    def read(self, key):
+        if self.objects[key] is None:
+            return (key.encode('utf-8') * (self.filler_size // len(key) + 1))[:self.filler_size]
+        with open(self.objects[key], 'rb') as object_file:
+            return object_file.read()
+
+    def get_size(self, key):
+        return self.filler_size if self.objects[key] is None else os.path.getsize(self.objects[key])
+
+    def get_etag(self, key):
+        if key not in self.etags:
+            self.etags[key] = hashlib.md5(self.read(key)).hexdigest()
+        return self.etags[key]
+
+    def list_page(self, params, page_size):
+        prefix = params.get('prefix', '')
+        delimiter = params.get('delimiter')
+        list_type = params.get('list-type', '1')
+        start_after = params.get('continuation-token' if list_type == '2' else 'marker', '')
+        contents = []
+        common_prefixes = []
+        truncated = False
+        for key in self.keys:
+            if not key.startswith(prefix) or key <= start_after:
+                continue
+            if len(contents) + len(common_prefixes) == page_size:
+                truncated = True
+                break
+            if delimiter and delimiter in key[len(prefix):]:
+                common_prefix = key[:key.index(delimiter, len(prefix)) + len(delimiter)]
+                if common_prefix <= start_after:
+                    continue
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+                    start_after = common_prefix + '\U0010ffff' # skips the rest of the group
+                continue
+            contents.append(key)
+
+        body = ['<?xml version="1.0" encoding="UTF-8"?>', '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">']
+        body.append('<IsTruncated>{}</IsTruncated>'.format('true' if truncated else 'false'))
+        last = max(contents[-1:] + common_prefixes[-1:]) if truncated else None
+        if truncated and list_type == '2':
+            body.append('<NextContinuationToken>{}</NextContinuationToken>'.format(escape(last)))
+        elif truncated and delimiter:
+            body.append('<NextMarker>{}</NextMarker>'.format(escape(last)))
+        for key in contents:
+            body.append('<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>&quot;{}&quot;</ETag><Size>{}</Size></Contents>'.format(
+                escape(key), LAST_MODIFIED, self.get_etag(key), self.get_size(key)))
+        for common_prefix in common_prefixes:
+            body.append('<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'.format(escape(common_prefix)))
+        body.append('</ListBucketResult>')
+        return '\n'.join(body).encode('utf-8')
+
+def make_handler(bucket, page_size, latency):
+    class FakeS3Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_HEAD(self):
+            self.respond(False)
+
+        def do_GET(self):
+            self.respond(True)
+
+        def send(self, status, data, headers={}, body_wanted=True):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            if body_wanted:
+                self.wfile.write(data)
+
+        def respond(self, body_wanted):
+            if latency > 0:
+                time.sleep(latency)
+            url = urlparse(self.path)
+            key = url.path.lstrip('/')
+            if len(key) == 0:
+                self.send(200, bucket.list_page(dict(parse_qsl(url.query)), page_size), {'Content-Type': 'application/xml'}, body_wanted)
+                return
+            if key not in bucket.objects:
+                self.send(404, b'', body_wanted=body_wanted)
+                return
+            data = bucket.read(key)
+            headers = {'Accept-Ranges': 'bytes', 'ETag': '"{}"'.format(bucket.get_etag(key))}
+            byte_range = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+            if byte_range is None or self.headers.get('If-Range', headers['ETag']) != headers['ETag']: # whole object once it changed
+                self.send(200, data, headers, body_wanted)
+                return
+            start = int(byte_range.group(1))
+            end = int(byte_range.group(2)) if byte_range.group(2) else len(data) - 1
+            if start >= len(data):
+                self.send(416, b'', {'Content-Range': 'bytes */{}'.format(len(data))}, body_wanted)
+                return
+            end = min(end, len(data) - 1)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(data))
+            self.send(206, data[start:end + 1], headers, body_wanted)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeS3Handler
+
+def start_server(directory, port=0, page_size=1000, latency=0.0, filler_count=0, filler_size=1024):
+    # serves in a background thread. Returns the server, its url is 'http://127.0.0.1:{}/'.format(server.server_port)
+    bucket = FakeBucket(directory, filler_count, filler_size)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(bucket, page_size, latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("dir", help="Directory whose files are served as the bucket's keys.")
+    parser.add_argument("--port", type=int, required=False, default=8000, help="Default is 8000.")
+    parser.add_argument("--page-size", type=int, required=False, default=1000, help="Keys per listing page. S3 uses 1000.")
+    parser.add_argument("--latency-ms", type=float, required=False, default=0, help="Delay before every response, in milliseconds.")
+    parser.add_argument("--filler-keys", type=int, required=False, default=0, help="Extra generated keys under {} to make the listing longer.".format(FILLER_PREFIX))
+    args = parser.parse_args()
+    server = start_server(args.dir, args.port, args.page_size, args.latency_ms / 1000, args.filler_keys)
+    print('Serving {} at http://127.0.0.1:{}/'.format(args.dir, server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
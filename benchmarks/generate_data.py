@@ -0,0 +1,183 @@
+from argparse import ArgumentParser
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+# Synthetic inputs in the layouts the converters in column_conversions.py expect (see the column lists there).
+# Everything is drawn from a seeded generator, so the same arguments always write the same files.
+STATION_COUNT = 300
+CITY_CENTERS = {
+    'nyc': (40.73, -73.99),
+    'boston': (42.36, -71.07),
+    'portland': (45.52, -122.67),
+    'columbus': (39.96, -83.00),
+}
+NYC_COLUMNS = ['tripduration', 'starttime', 'stoptime', 'start station id', 'start station name', 'start station latitude', 'start station longitude', 'end station id', 'end station name', 'end station latitude', 'end station longitude', 'bikeid', 'usertype', 'birth year', 'gender']
+PORTLAND_COLUMNS = ['BikeID', 'BikeName', 'Distance_Miles', 'Duration', 'EndDate', 'EndHub', 'EndLatitude', 'EndLongitude', 'EndTime', 'MultipleRental', 'PaymentPlan', 'RentalAccessPath', 'RouteID', 'StartDate', 'StartHub', 'StartLatitude', 'StartLongitude', 'StartTime', 'TripType']
+COLUMBUS_COLUMNS = ['bikeid', 'birthyear', 'end_time', 'from_station_id', 'from_station_location', 'from_station_name', 'gender', 'start_time', 'to_station_id', 'to_station_location', 'to_station_name', 'trip_id', 'tripduration', 'usertype']
+WEATHER_TYPES = ['-RA:02 BR:1 |RA BR |RA BR', 'RA:02 |RA |RA', '+RA:02 |RA |RA', 'SN:03 |SN |SN', 'HZ:7 |HZ |HZ', 'VCTS:7 |TS |TS', 'DZ:1 FG:2 |DZ FG |DZ', 'BR:1 ||']
+
+def get_filename(city, year, month):
+    return {
+        'nyc': '{}{:02d}-citibike-tripdata.csv',
+        'boston': '{}{:02d}-bluebikes-tripdata.csv',
+        'portland': '{}_{:02d}.csv',
+        'columbus': '{}{:02d}-cogo-tripdata.csv',
+    }[city].format(year, month)
+
+def random_trips(rng, city, year, month, count):
+    center = CITY_CENTERS[city]
+    stations = np.column_stack([center[0] + rng.uniform(-0.05, 0.05, STATION_COUNT), center[1] + rng.uniform(-0.05, 0.05, STATION_COUNT)]).round(6)
+    start_station = rng.integers(0, STATION_COUNT, count)
+    end_station = rng.integers(0, STATION_COUNT, count)
+    month_start = pd.Timestamp(year=year, month=month, day=1)
+    month_seconds = int((month_start + pd.offsets.MonthBegin(1) - month_start).total_seconds())
+    start = month_start + pd.to_timedelta(np.sort(rng.integers(0, month_seconds - 6 * 3600, count)), unit='s')
+    duration = rng.integers(60, 4 * 3600, count)
+    end = start + pd.to_timedelta(duration, unit='s')
+    return {
+        'start_station': start_station, 'end_station': end_station, 'stations': stations,
+        'start': pd.Series(start), 'end': pd.Series(end), 'duration': duration,
+        'birth_year': rng.choice([np.nan] + list(range(1950, 2003)), count),
+        'gender': rng.choice([0, 1, 2], count),
+    }
+
+def nyc_layout(rng, trips, count):
+    stations = trips['stations']
+    return pd.DataFrame({
+        'tripduration': trips['duration'],
+        'starttime': trips['start'].dt.strftime('%Y-%m-%d %H:%M:%S.%f').str[:24],
+        'stoptime': trips['end'].dt.strftime('%Y-%m-%d %H:%M:%S.%f').str[:24],
+        'start station id': trips['start_station'],
+        'start station name': ['Station {}'.format(station) for station in trips['start_station']],
+        'start station latitude': stations[trips['start_station'], 0],
+        'start station longitude': stations[trips['start_station'], 1],
+        'end station id': trips['end_station'],
+        'end station name': ['Station {}'.format(station) for station in trips['end_station']],
+        'end station latitude': stations[trips['end_station'], 0],
+        'end station longitude': stations[trips['end_station'], 1],
+        'bikeid': rng.integers(10000, 40000, count),
+        'usertype': rng.choice(['Subscriber', 'Customer'], count, p=[0.8, 0.2]),
+        'birth year': trips['birth_year'],
+        'gender': trips['gender'],
+    }, columns=NYC_COLUMNS)
+
+def portland_layout(rng, trips, count):
+    stations = trips['stations']
+    end_latitude = stations[trips['end_station'], 0].astype(object)
+    end_latitude[rng.random(count) < 0.02] = np.nan # some Portland trips end away from a hub
+    return pd.DataFrame({
+        'BikeID': rng.integers(1000, 9000, count), 'BikeName': 'bike', 'Distance_Miles': rng.uniform(0.2, 8, count).round(2),
+        'Duration': trips['duration'],
+        'EndDate': trips['end'].dt.strftime('%-m/%-d/%Y'), 'EndHub': 'hub',
+        'EndLatitude': end_latitude, 'EndLongitude': stations[trips['end_station'], 1],
+        'EndTime': trips['end'].dt.strftime('%-H:%M'), 'MultipleRental': False,
+        'PaymentPlan': rng.choice(['Casual', 'Subscriber'], count), 'RentalAccessPath': 'keypad', 'RouteID': np.arange(count),
+        'StartDate': trips['start'].dt.strftime('%-m/%-d/%Y'), 'StartHub': 'hub',
+        'StartLatitude': stations[trips['start_station'], 0], 'StartLongitude': stations[trips['start_station'], 1],
+        'StartTime': trips['start'].dt.strftime('%-H:%M'), 'TripType': '',
+    }, columns=PORTLAND_COLUMNS)
+
+def columbus_layout(rng, trips, count):
+    stations = trips['stations']
+    locations = np.array(['{},{}'.format(latitude, longitude) for latitude, longitude in stations])
+    return pd.DataFrame({
+        'bikeid': rng.integers(1000, 9000, count), 'birthyear': trips['birth_year'],
+        'end_time': trips['end'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'from_station_id': trips['start_station'], 'from_station_location': locations[trips['start_station']], 'from_station_name': 'station',
+        'gender': rng.choice(['Male', 'Female'], count),
+        'start_time': trips['start'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'to_station_id': trips['end_station'], 'to_station_location': locations[trips['end_station']], 'to_station_name': 'station',
+        'trip_id': np.arange(count), 'tripduration': trips['duration'],
+        'usertype': rng.choice(['Subscriber', 'Customer', 'Dependent'], count),
+    }, columns=COLUMBUS_COLUMNS)
+
+LAYOUTS = {
+    'nyc': nyc_layout,
+    'boston': nyc_layout, # same columns as nyc since February 2018
+    'portland': portland_layout,
+    'columbus': columbus_layout,
+}
+
+def write_trips(directory, cities, months, trips_per_month, seed=0):
+    # writes {directory}/{city}/{monthly file} for each city and each (year, month). Returns the paths
+    rng = np.random.default_rng(seed)
+    paths = []
+    for city in cities:
+        os.makedirs(os.path.join(directory, city), exist_ok=True)
+        for year, month in months:
+            trips = random_trips(rng, city, year, month, trips_per_month)
+            path = os.path.join(directory, city, get_filename(city, year, month))
+            LAYOUTS[city](rng, trips, trips_per_month).to_csv(path, index=False)
+            paths.append(path)
+    return paths
+
+def write_weather(path, start='2018-01-25', end='2020-01-05', seed=0):
+    # NOAA LCD style hourly file: a report every hour plus extra special reports, many columns that aren't used,
+    # and gaps and 's' (suspect) suffixes in the hourly values
+    rng = np.random.default_rng(seed)
+    hours = pd.date_range(start, end, freq='h')
+    extra = hours[rng.random(len(hours)) < 0.3] # special reports between the hourly ones
+    times = hours.union(extra + pd.to_timedelta(rng.integers(1, 59, len(extra)), unit='m'))
+    count = len(times)
+
+    def with_gaps(values, missing_share=0.05):
+        values = values.astype(object)
+        values[rng.random(count) < missing_share] = ''
+        return values
+
+    df = pd.DataFrame({
+        'STATION': '72503014732',
+        'DATE': times.strftime('%Y-%m-%dT%H:%M:%S'),
+        'REPORT_TYPE': rng.choice(['FM-15', 'FM-16'], count, p=[0.8, 0.2]),
+        'SOURCE': 7,
+        'HourlyAltimeterSetting': with_gaps(rng.uniform(29.5, 30.5, count).round(2)),
+        'HourlyDewPointTemperature': with_gaps(rng.integers(-10, 75, count)),
+        'HourlyDryBulbTemperature': with_gaps(np.array(['{}{}'.format(value, 's' if suspect else '') for value, suspect in zip(rng.integers(0, 95, count), rng.random(count) < 0.01)])),
+        'HourlyPrecipitation': with_gaps(rng.choice(['0.00', 'T', '0.01', '0.02', '0.10'], count), 0.2),
+        'HourlyPresentWeatherType': with_gaps(rng.choice(WEATHER_TYPES, count), 0.7),
+        'HourlyPressureChange': '',
+        'HourlyPressureTendency': '',
+        'HourlyRelativeHumidity': with_gaps(rng.integers(10, 100, count)),
+        'HourlySkyConditions': 'CLR:00',
+        'HourlySeaLevelPressure': with_gaps(rng.uniform(29.5, 30.5, count).round(2)),
+        'HourlyStationPressure': with_gaps(rng.uniform(29.5, 30.5, count).round(2)),
+        'HourlyVisibility': with_gaps(rng.choice([10.0, 9.94, 5.0, 1.5], count)),
+        'HourlyWetBulbTemperature': with_gaps(rng.integers(0, 80, count)),
+        'HourlyWindDirection': with_gaps(rng.integers(0, 360, count)),
+        'HourlyWindGustSpeed': '',
+        'HourlyWindSpeed': with_gaps(rng.integers(0, 30, count)),
+    })
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df.to_csv(path, index=False)
+    return path
+
+def write_bucket(directory, trip_paths):
+    # zips each monthly file into directory, like the bike share buckets publish them. Returns the zip paths
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for trip_path in trip_paths:
+        zip_path = os.path.join(directory, os.path.basename(trip_path) + '.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(trip_path, os.path.basename(trip_path))
+        paths.append(zip_path)
+    return paths
+
+def get_months(count, first_year=2019, first_month=1):
+    return [(first_year + (first_month - 1 + index) // 12, (first_month - 1 + index) % 12 + 1) for index in range(count)]
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("dir", help="Trips are written to {dir}/bss/{city}/, weather to {dir}/weather/ and zipped trips to {dir}/bucket/.")
+    parser.add_argument("--cities", required=False, default=','.join(LAYOUTS.keys()), help="Comma-separated cities. Default is every city.")
+    parser.add_argument("--months", type=int, required=False, default=2, help="Number of months per city, starting January 2019. Default is 2.")
+    parser.add_argument("--trips", type=int, required=False, default=10000, help="Trips per monthly file. Default is 10000.")
+    parser.add_argument("--seed", type=int, required=False, default=0)
+    parser.add_argument("--bucket", required=False, action="store_true", default=False, help="Also writes each monthly file zipped into {dir}/bucket/.")
+    args = parser.parse_args()
+    trip_paths = write_trips(os.path.join(args.dir, 'bss'), args.cities.split(','), get_months(args.months), args.trips, args.seed)
+    write_weather(os.path.join(args.dir, 'weather', 'weather.csv'), seed=args.seed)
+    if args.bucket:
+        write_bucket(os.path.join(args.dir, 'bucket'), trip_paths)
+    print('Wrote {} monthly files to {}'.format(len(trip_paths), os.path.join(args.dir, 'bss')))
@@ -0,0 +1,178 @@
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_s3 import start_server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+STAGES = ['list', 'download', 'merge', 'update_weather', 'merge_weather', 'pipeline']
+CITIES = ['nyc', 'boston', 'portland', 'columbus']
+WEATHER_CITY = 'nyc'
+PIPELINE_CONFIG = 'sources.json'
+
+# Runs each stage of the pipeline as its own process on synthetic data of every size, timing it and recording its peak
+# resident memory, and saves everything as one JSON file per run. The scripts are run from REPO_DIR as they are on disk,
+# so checking out another commit and running this again gives numbers to compare with --compare. Data is generated in
+# a separate process too: a child's peak memory starts at whatever this process held when it forked, so this one never
+# imports pandas. The pipeline stage runs pipeline.py --partitioned with --merge-jobs 2 for WEATHER_CITY in a directory
+# of its own, so the partitioned steps' worker processes are exercised too. The run exits with 1 if any stage failed.
+def run_stage(command, cwd, log_path):
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            peak_rss_MB = usage.ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+        else:
+            returncode = process.wait()
+            peak_rss_MB = None
+    seconds = time.perf_counter() - start
+    if returncode != 0:
+        print('[WARN] {} exited with {}, see {}'.format(' '.join(command), returncode, log_path))
+    return {'seconds': round(seconds, 3), 'peak_rss_MB': round(peak_rss_MB, 1) if peak_rss_MB is not None else None, 'returncode': returncode}
+
+def get_commands(stage, url, merger_args):
+    python = sys.executable
+    return {
+        'list': [python, os.path.join(REPO_DIR, 'file-downloader.py'), url, '-s', '-c', '1000000'],
+        'download': [python, os.path.join(REPO_DIR, 'file-downloader.py'), url, '-D', '--dir', 'downloads', '-m', '0', '-c', '1000000', '-w', '4', '-p', r'.*\.zip$', '-x'],
+        'merge': [python, os.path.join(REPO_DIR, 'merger.py')] + merger_args,
+        'update_weather': [python, os.path.join(REPO_DIR, 'update_weather.py'), '{}=../weather/weather.csv'.format(WEATHER_CITY)],
+        'merge_weather': [python, '-c', 'import runpy, sys; sys.path.insert(0, {!r}); runpy.run_path({!r})["add_nearest_weather"]({!r}, False)'.format(
+            REPO_DIR, os.path.join(REPO_DIR, 'merge-weather.py'), WEATHER_CITY)],
+        'pipeline': [python, os.path.join(REPO_DIR, 'pipeline.py'), 'merge', 'update_weather', 'merge_weather', '--cities', WEATHER_CITY, '--config', PIPELINE_CONFIG,
+            '--partitioned', '--merge-jobs', '2'],
+    }[stage]
+
+def get_cwd(stage, size_dir):
+    if stage in ('update_weather', 'merge_weather'):
+        return os.path.join(size_dir, 'weather-run') # merge-weather.py reads ../final-bss-data/{city}_bss.csv
+    if stage == 'pipeline':
+        return os.path.join(size_dir, 'pipeline-run')
+    return size_dir
+
+def prepare_pipeline_run(size_dir):
+    # a fresh data directory with the generated trips and a config pointing at the generated weather
+    run_dir = get_cwd('pipeline', size_dir)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    shutil.copytree(os.path.join(size_dir, 'bss', WEATHER_CITY), os.path.join(run_dir, 'bss', WEATHER_CITY))
+    with open(os.path.join(run_dir, PIPELINE_CONFIG), 'w') as config_file:
+        json.dump({WEATHER_CITY: {'weather': os.path.join('..', 'weather', 'weather.csv')}}, config_file)
+
+def benchmark_size(args, trips_per_month, work_dir):
+    size_dir = os.path.join(work_dir, 'trips-{}'.format(trips_per_month))
+    log_dir = os.path.join(work_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(os.path.join(size_dir, 'weather-run'), exist_ok=True)
+    print('Generating {} trips per month for {}'.format(trips_per_month, ', '.join(args.cities)))
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, 'benchmarks', 'generate_data.py'), size_dir, '--bucket', '--cities', ','.join(args.cities),
+        '--months', str(args.months), '--trips', str(trips_per_month), '--seed', str(args.seed)], check=True, stdout=subprocess.DEVNULL)
+
+    server = start_server(os.path.join(size_dir, 'bucket'), page_size=args.page_size, latency=args.latency_ms / 1000, filler_count=args.filler_keys)
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+    results = []
+    try:
+        for stage in args.stages:
+            if stage == 'merge_weather':
+                bss_path = os.path.join(size_dir, '{}_bss.csv'.format(WEATHER_CITY))
+                if not os.path.isfile(bss_path):
+                    print('[WARN] skipping merge_weather, it needs the merge stage to write {}'.format(bss_path))
+                    continue
+                os.makedirs(os.path.join(size_dir, 'final-bss-data'), exist_ok=True)
+                shutil.copy(bss_path, os.path.join(size_dir, 'final-bss-data'))
+            elif stage == 'pipeline':
+                prepare_pipeline_run(size_dir)
+            log_path = os.path.join(log_dir, '{}-{}.log'.format(stage, trips_per_month))
+            result = run_stage(get_commands(stage, url, args.merger_args), get_cwd(stage, size_dir), log_path)
+            result.update({'stage': stage, 'trips_per_month': trips_per_month, 'trip_rows': trips_per_month * args.months * len(args.cities)})
+            print('{:>15} {:>9} trips/month: {:8.2f} s {:>8} MB peak'.format(stage, trips_per_month, result['seconds'], result['peak_rss_MB']))
+            results.append(result)
+    finally:
+        server.shutdown()
+    return results
+
+def get_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = len(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()) > 0
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def compare(old_path, new_path):
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    old_results = {(result['stage'], result['trips_per_month']): result for result in old['results']}
+    print('{} -> {}'.format((old.get('commit') or old_path)[:10], (new.get('commit') or new_path)[:10]))
+    print('{:>15} {:>10} {:>10} {:>10} {:>8} {:>10} {:>10}'.format('stage', 'trips', 'old s', 'new s', 'speedup', 'old MB', 'new MB'))
+    for result in new['results']:
+        previous = old_results.get((result['stage'], result['trips_per_month']))
+        if previous is None:
+            continue
+        speedup = previous['seconds'] / result['seconds'] if result['seconds'] > 0 else float('inf')
+        print('{:>15} {:>10} {:>10.2f} {:>10.2f} {:>7.2f}x {:>10} {:>10}'.format(result['stage'], result['trips_per_month'], previous['seconds'], result['seconds'], speedup, previous['peak_rss_MB'], result['peak_rss_MB']))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", required=False, default="1000,10000,100000", help="Comma-separated trips per monthly file. Every stage runs once per size. Default is 1000,10000,100000.")
+    parser.add_argument("--stages", required=False, default=','.join(STAGES), help="Comma-separated stages out of {}. Default is all of them.".format(', '.join(STAGES)))
+    parser.add_argument("--cities", required=False, default=','.join(CITIES), help="Comma-separated cities to generate trips for. Default is every city.")
+    parser.add_argument("--months", type=int, required=False, default=2, help="Monthly files per city. Default is 2.")
+    parser.add_argument("--seed", type=int, required=False, default=0)
+    parser.add_argument("--latency-ms", type=float, required=False, default=20, help="Delay the fake bucket adds to every response. Default is 20 ms.")
+    parser.add_argument("--page-size", type=int, required=False, default=1000, help="Keys per listing page of the fake bucket. Default is 1000, like S3.")
+    parser.add_argument("--filler-keys", type=int, required=False, default=5000, help="Extra keys in the fake bucket that are listed but not downloaded. Default is 5000.")
+    parser.add_argument("--merger-args", required=False, default="", help="Extra arguments for merger.py, e.g. '--distance vincenty --jobs 4'.")
+    parser.add_argument("--work-dir", required=False, help="Where data is generated and stages run. Default is a temporary directory that is deleted afterwards.")
+    parser.add_argument("--output", required=False, help="Results file. Default is benchmarks/results/{commit}-{time}.json.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), required=False, help="Prints a comparison of two results files instead of running anything.")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    args.stages = args.stages.split(',')
+    args.cities = args.cities.split(',')
+    args.merger_args = shlex.split(args.merger_args)
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error('{} is not a valid stage'.format(stage))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bss-benchmarks-')
+    commit, dirty = get_commit()
+    results = []
+    try:
+        for trips_per_month in [int(size) for size in args.sizes.split(',')]:
+            results += benchmark_size(args, trips_per_month, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('compare', 'output', 'work_dir')},
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, '{}-{}.json'.format((commit or 'unknown')[:10], datetime.now().strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print('Saved results to {}'.format(output))
+    failed = sorted(set([result['stage'] for result in results if result['returncode'] != 0]))
+    if len(failed) > 0:
+        print('[WARN] these stages failed: {}'.format(', '.join(failed)))
+        sys.exit(1)
@@ -1,7 +1,7 @@
-from datetime import datetime
-from geopy.distance import geodesic
 import pandas as pd
 import numpy as np
+from distances import DistanceCache, compute_distances
+from instrumentation import stage
 
 TRIP_DURATION = 'trip_duration' # computed for all from START_DATETIME and STOP_TIME. Don't use duration precomputed by some
 START_DATETIME = 'start_datetime'
@@ -24,73 +24,194 @@ CITY = 'city'
 
 FINAL_COLUMNS = [TRIP_DURATION, START_DATETIME, START_HOUR, START_DAY_OF_WEEK, DISTANCE, AGE, GENDER, IS_SUBSCRIBER, CITY]
 coordinate_columns = [START_LAT, START_LONG, END_LAT, END_LONG]
+OUTPUT_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DAY_NAMES = np.array(['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']) # indexed by dt.dayofweek
+HOUR_STRINGS = np.array(['{:02d}'.format(hour) for hour in range(24)])
+# IS_SUBSCRIBER categories each city has used, keyed by the one that becomes 'Yes'. Everything else becomes 'No'
+SUBSCRIBER_SCHEMES = {
+    'Subscriber': [['Customer', 'Subscriber'], ['Casual', 'Subscriber'], ['Customer', 'Dependent', 'Subscriber']],
+    'member': [['casual', 'member']],
+}
+
+# Column types for the typed (parquet/feather) outputs and for compact conversions. Categories are fixed up front so every
+# file and chunk gets the same schema. Values outside them, like the '' used for unknown genders, are stored as missing.
+FINAL_DTYPES = {
+    TRIP_DURATION: 'float64',
+    START_DATETIME: 'datetime64[ns]',
+    START_HOUR: 'int8',
+    START_DAY_OF_WEEK: pd.CategoricalDtype(list(DAY_NAMES)),
+    DISTANCE: 'float32',
+    AGE: 'float32',
+    GENDER: pd.CategoricalDtype(['Male', 'Female']),
+    IS_SUBSCRIBER: pd.CategoricalDtype(['Yes', 'No']),
+    CITY: pd.CategoricalDtype(['boston', 'columbus', 'nyc', 'portland', 'sf']),
+}
+
+# How the source columns mapped to these are read, so the csv parser doesn't infer their types. Birth years and genders
+# are left to inference since cities write them as numbers, strings or placeholders like \N
+SOURCE_DTYPES = {
+    START_DATETIME: str,
+    END_DATETIME: str,
+    START_LAT: 'float64',
+    START_LONG: 'float64',
+    END_LAT: 'float64',
+    END_LONG: 'float64',
+    IS_SUBSCRIBER: str,
+}
+
+def apply_final_dtypes(df):
+    df = df.copy()
+    for column, dtype in FINAL_DTYPES.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if dtype == 'datetime64[ns]':
+            df[column] = pd.to_datetime(df[column], format=OUTPUT_DATETIME_FORMAT)
+        elif dtype in ('int8', 'float32', 'float64'):
+            df[column] = pd.to_numeric(df[column]).astype(dtype)
+        else:
+            df[column] = df[column].where(df[column].isin(dtype.categories)).astype(dtype)
+    return df
+
 class Converter():
+    datetime_format = OUTPUT_DATETIME_FORMAT # format of START_DATETIME/END_DATETIME strings after update_pre_conversion
+    extra_source_columns = {} # {column: dtype} of source columns update_pre_conversion reads besides the conversions
+
     def __init__(self, city_name, conversions, no_info_list=[]):
         super().__init__()
         self.city_name = city_name
         self.conversions = conversions
         self.no_info_list = no_info_list
-
-    def convert(self, df):
-        info_list = set([GENDER, BIRTH_YEAR]) - set(self.no_info_list)
-        self.update_pre_conversion(df)
-        specific_conversions = {original: replacement for original, replacement in self.conversions.items() if original in df.columns}
-
-        df.rename(columns=specific_conversions, inplace=True)
-        have_coordinates = df[coordinate_columns].notna().apply(lambda row: all(row), axis=1)
-        df = df.loc[have_coordinates]
-
-        info_list -= set(df.columns)
+        self.distance_cache = DistanceCache(city=city_name) # set up by use_distance_cache to persist between runs
+
+    # compact=True returns FINAL_DTYPES columns (datetimes, small ints, float32 and categories) instead of the csv strings
+    def convert(self, df, distance_method='geodesic', compact=False):
+        with stage('convert', city=self.city_name) as convert_stage:
+            df = self.prepare(df)
+            self.print_missing_info(df)
+            subscriber_value = self.get_subscriber_value(df[IS_SUBSCRIBER])
+            if subscriber_value is None:
+                print("[WARN] subscriber categories weren't set correctly")
+            df = self.finish(df, subscriber_value, distance_method, compact)
+            self.distance_cache.save()
+            convert_stage.add(rows=len(df))
+        return df
+
+    def convert_chunks(self, chunks, distance_method='geodesic', compact=False):
+        # Converts a file that's read a chunk at a time (e.g. pd.read_csv(..., chunksize=...)) and yields each converted chunk.
+        # The subscriber categories are decided once per file, from the first chunk with any trips, and used for every chunk
+        subscriber_value = None
+        decided = False
+        warned = False
+        for chunk_number, chunk in enumerate(chunks):
+            with stage('convert', city=self.city_name, chunk=chunk_number) as convert_stage:
+                df = self.prepare(chunk)
+                if chunk_number == 0:
+                    self.print_missing_info(df)
+                if len(df) > 0:
+                    chunk_subscriber_value = self.get_subscriber_value(df[IS_SUBSCRIBER])
+                    if not decided:
+                        subscriber_value = chunk_subscriber_value
+                        decided = True
+                    if not warned and (subscriber_value is None or chunk_subscriber_value != subscriber_value):
+                        print("[WARN] subscriber categories weren't set correctly")
+                        warned = True
+                df = self.finish(df, subscriber_value, distance_method, compact)
+                convert_stage.add(rows=len(df))
+            yield df
+        self.distance_cache.save()
+
+    def get_source_dtypes(self, header):
+        # {column: dtype or None to infer it} for the columns of header the conversion uses. The rest don't need to be read
+        dtypes = {}
+        for column in header:
+            if column in self.conversions:
+                dtypes[column] = SOURCE_DTYPES.get(self.conversions[column])
+            elif column in self.extra_source_columns:
+                dtypes[column] = self.extra_source_columns[column]
+        return dtypes
+
+    def prepare(self, df):
+        with stage('convert.pre_conversion', city=self.city_name) as pre_conversion_stage:
+            self.update_pre_conversion(df)
+            pre_conversion_stage.add(rows=len(df))
+        df.columns = [self.conversions.get(column, column) for column in df.columns] # renames without copying the data
+        have_coordinates = df[coordinate_columns].notna().all(axis=1)
+        if not have_coordinates.all():
+            df = df.take(np.flatnonzero(have_coordinates.to_numpy())) # a new frame, not a view that later columns would warn about
+        return df
+
+    def print_missing_info(self, df):
+        info_list = set([GENDER, BIRTH_YEAR]) - set(self.no_info_list) - set(df.columns)
         if len(info_list) > 0:
             print("[INFO] the following columns weren't in the df before final updates: {}".format(info_list))
-        
-        subscriber_values = sorted(df[IS_SUBSCRIBER].unique())
-        unique_options = [['Customer', 'Subscriber'], ['Casual', 'Subscriber'], ['Customer', 'Dependent', 'Subscriber']]
-        if any([subscriber_values == options for options in unique_options]):
-            df[IS_SUBSCRIBER] = df[IS_SUBSCRIBER].apply(lambda item: 'Yes' if item == 'Subscriber' else 'No')
-        elif  subscriber_values == ['casual', 'member']:
-            df[IS_SUBSCRIBER] = df[IS_SUBSCRIBER].apply(lambda item: 'Yes' if item == 'member' else 'No')
-        else:
-            print("[WARN] subscriber categories weren't set correctly")
-        
-        self.add_computed_values(df)
+
+    def get_subscriber_value(self, values):
+        # the value that means subscriber in whichever scheme the values belong to, or None if they don't fit one.
+        # A chunk of a file may only hold some of the categories, so any subset of a scheme is accepted
+        subscriber_values = set(values.unique())
+        if len(subscriber_values) == 0:
+            return None
+        for subscriber_value, options in SUBSCRIBER_SCHEMES.items():
+            if any([subscriber_values <= set(scheme) for scheme in options]):
+                return subscriber_value
+        return None
+
+    def finish(self, df, subscriber_value, distance_method='geodesic', compact=False):
+        with stage('convert.subscribers', city=self.city_name) as subscribers_stage:
+            if subscriber_value is not None and compact:
+                df[IS_SUBSCRIBER] = pd.Categorical.from_codes(np.where(df[IS_SUBSCRIBER] == subscriber_value, 0, 1), dtype=FINAL_DTYPES[IS_SUBSCRIBER])
+            elif subscriber_value is not None:
+                df[IS_SUBSCRIBER] = np.where(df[IS_SUBSCRIBER] == subscriber_value, 'Yes', 'No')
+            subscribers_stage.add(rows=len(df))
+        self.add_computed_values(df, distance_method, compact)
         self.update_post_conversion(df)
         for column in FINAL_COLUMNS:
             if column not in df.columns:
-                df[column] = ''
+                df[column] = np.nan if compact else ''
+        if compact:
+            return apply_final_dtypes(df[FINAL_COLUMNS])
         return df[FINAL_COLUMNS]
 
-    def add_computed_values(self, df):
-        df[CITY] = [self.city_name] * len(df)
+    def add_computed_values(self, df, distance_method='geodesic', compact=False):
+        df[CITY] = pd.Series(self.city_name, index=df.index, dtype=FINAL_DTYPES[CITY] if compact else object)
         gender_mapper = {0: '', 1: 'Male', 2: 'Female', 'Male': 'Male', 'Female': 'Female'}
         if GENDER in df.columns:
             df[GENDER] = df[GENDER].map(gender_mapper)
 
-        def get_age(row):
-            if pd.isnull(row[1]):
-                return np.NaN
-            current_year = int(row[0][0:4])
-            return current_year - row[1]
+        start_strings = df[START_DATETIME]
+        with stage('convert.datetimes', city=self.city_name) as datetimes_stage:
+            start_datetimes = self.parse_datetimes(df[START_DATETIME])
+            end_datetimes = self.parse_datetimes(df[END_DATETIME])
+            datetimes_stage.add(rows=len(df))
         if BIRTH_YEAR in df.columns:
-            df[AGE] = df[[START_DATETIME, BIRTH_YEAR]].apply(get_age, axis=1)
+            df[AGE] = (start_datetimes.dt.year - pd.to_numeric(df[BIRTH_YEAR])).astype(float) # float even without missing years, so every file and chunk writes ages the same way
         else:
             df[AGE] = np.nan
 
-        def get_distance(row):
-            return geodesic((row[0], row[1]), (row[2], row[3])).kilometers
-        df[DISTANCE] = df[coordinate_columns].apply(get_distance, axis=1)
-
-        df[START_DATETIME] = df[START_DATETIME].apply(lambda date_string: date_string[:19]) # removes decimals. Date format must be 2019-01-31 17:57:44.1234
-        df[END_DATETIME] = df[END_DATETIME].apply(lambda date_string: date_string[:19]) # removes decimals. Date format must be 2019-01-31 17:57:44.1234
-
-        def get_datetime(date_string):
-            return datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
-        start_datetimes = df[START_DATETIME].apply(get_datetime)
-        end_datetimes = df[END_DATETIME].apply(get_datetime)
-        df[START_DAY_OF_WEEK] = start_datetimes.apply(lambda date: date.strftime('%A'))
-        df[START_HOUR] = start_datetimes.apply(lambda date: date.strftime('%H'))
-        df[TRIP_DURATION] = end_datetimes - start_datetimes
-        df[TRIP_DURATION] = df[TRIP_DURATION].apply(lambda time_delta: time_delta.total_seconds())
+        with stage('convert.distance', city=self.city_name, method=distance_method) as distance_stage:
+            coordinates = [pd.to_numeric(df[column]).to_numpy() for column in coordinate_columns] # columbus coordinates are parsed from strings
+            df[DISTANCE] = compute_distances(*coordinates, method=distance_method, cache=self.distance_cache)
+            distance_stage.add(rows=len(df))
+
+        if compact:
+            df[START_DATETIME] = start_datetimes
+        elif pd.api.types.is_datetime64_any_dtype(start_strings) or self.datetime_format != OUTPUT_DATETIME_FORMAT:
+            df[START_DATETIME] = start_datetimes.dt.strftime(OUTPUT_DATETIME_FORMAT)
+        else:
+            df[START_DATETIME] = start_strings.str[:19] # already in the output format, so skip formatting every row again
+        df[END_DATETIME] = end_datetimes
+        if compact:
+            df[START_DAY_OF_WEEK] = pd.Categorical.from_codes(start_datetimes.dt.dayofweek.to_numpy(), dtype=FINAL_DTYPES[START_DAY_OF_WEEK])
+            df[START_HOUR] = start_datetimes.dt.hour.to_numpy().astype(FINAL_DTYPES[START_HOUR])
+        else:
+            df[START_DAY_OF_WEEK] = DAY_NAMES[start_datetimes.dt.dayofweek.to_numpy()]
+            df[START_HOUR] = HOUR_STRINGS[start_datetimes.dt.hour.to_numpy()]
+        df[TRIP_DURATION] = (end_datetimes - start_datetimes).dt.total_seconds()
+
+    def parse_datetimes(self, values):
+        if pd.api.types.is_datetime64_any_dtype(values): # already parsed by update_pre_conversion
+            return values
+        return pd.to_datetime(values.str[:19], format=self.datetime_format) # removes decimals. Date format must be 2019-01-31 17:57:44.1234
     
     def update_pre_conversion(self, df):
         pass # TODO implement in subclass
@@ -138,28 +259,15 @@ PORTLAND_CONVERSIONS['End_Longitude'] = END_LONG
 # PORTLAND_CONVERSIONS['EndHub'] = END_STATION_NAME
 PORTLAND_CONVERSIONS['PaymentPlan'] = IS_SUBSCRIBER
 
-def reformat_date(date_string):
-    month, day, year = date_string.split('/')
-    if len(month) == 1:
-        month = '0' + month
-    if len(day) == 1:
-        day = '0' + day
-    return '{}-{}-{}'.format(year, month, day)
-
 class PortlandConverter(Converter):
+    extra_source_columns = {'StartDate': str, 'StartTime': str, 'EndDate': str, 'EndTime': str}
+
     def __init__(self):
         super().__init__('portland', PORTLAND_CONVERSIONS, [GENDER, BIRTH_YEAR])
 
     def update_pre_conversion(self, df):
-        def update_time_string(time_string):
-            if time_string.index(':') == 1:
-                time_string = '0' + time_string
-            return time_string + ':00'
-
-        def get_datetimes(date_column, time_column):
-            updated_times = df[time_column].apply(update_time_string)
-            updated_dates = df[date_column].apply(reformat_date)
-            return updated_dates + " " + updated_times
+        def get_datetimes(date_column, time_column): # dates like 7/28/2016 and times like 9:05
+            return pd.to_datetime(df[date_column] + ' ' + df[time_column], format='%m/%d/%Y %H:%M')
 
         df[START_DATETIME] = get_datetimes('StartDate', 'StartTime')
         df[END_DATETIME] = get_datetimes('EndDate', 'EndTime')
@@ -243,17 +351,15 @@ COLUMBUS_CONVERSIONS['usertype'] = IS_SUBSCRIBER
 COLUMBUS_CONVERSIONS.update(NEW_SF_COLUMBUS_CONVERSIONS)
 
 class ColumbusConverter(Converter):
+    extra_source_columns = {'Start Time and Date': str, 'Stop Time and Date': str, 'from_station_location': str, 'to_station_location': str}
+
     def __init__(self):
         super().__init__('columbus', COLUMBUS_CONVERSIONS, [GENDER, BIRTH_YEAR])
 
     def update_pre_conversion(self, df):
-        def update_date_string(date_string):
-            date, time = date_string.split(' ')
-            return reformat_date(date) + ' ' + time
-
         if 'Start Time and Date' in df.columns: # has bad date format: 7/28/2013 04:03:44
-            df[START_DATETIME] = df['Start Time and Date'].apply(update_date_string)
-            df[END_DATETIME] = df['Stop Time and Date'].apply(update_date_string)
+            df[START_DATETIME] = pd.to_datetime(df['Start Time and Date'], format='%m/%d/%Y %H:%M:%S')
+            df[END_DATETIME] = pd.to_datetime(df['Stop Time and Date'], format='%m/%d/%Y %H:%M:%S')
 
         def update_location(location_col, latitude_col, longitude_col):
             df[latitude_col] = df[location_col].apply(lambda lat_long_pair: lat_long_pair.split(',')[0])
@@ -277,10 +383,20 @@ CONVERTERS = {
 }
 CITIES = CONVERTERS.keys()
 
-def convert_df(df, city):
+def use_distance_cache(directory):
+    # distances of station pairs are kept in directory and reused by later files and runs
+    for city, converter in CONVERTERS.items():
+        converter.distance_cache = DistanceCache(directory, city)
+
+def convert_df(df, city, distance_method='geodesic', compact=False):
+    if city not in CITIES:
+        raise ValueError('{} is not a valid city'.format(city))
+    return CONVERTERS[city].convert(df, distance_method, compact)
+
+def convert_chunks(chunks, city, distance_method='geodesic', compact=False):
     if city not in CITIES:
         raise ValueError('{} is not a valid city'.format(city))
-    return CONVERTERS[city].convert(df)
+    return CONVERTERS[city].convert_chunks(chunks, distance_method, compact)
 
 # portland1 = pd.read_csv('./bss/portland/2020_07.csv')
 # portland2 = pd.read_csv('./bss/portland/2018_02.csv')
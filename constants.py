@@ -0,0 +1,16 @@
+# Names shared by the scripts and pipeline.py. Kept here, without pandas or numpy, so pipeline.py can build its
+# arguments (and --help stays fast) without importing the modules that use them.
+
+# output formats and their file extensions, see storage.py
+FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+}
+DISTANCE_METHOD_NAMES = ['geodesic', 'vincenty', 'haversine'] # each is a {name}_km function in distances.py
+CSV_ENGINES = ['c', 'pyarrow'] # see ingest.py
+
+# partitioned outputs, see partitions.py
+PARTITION_DIR = 'bss-partitions'
+COMPLETE_PARTITION_DIR = 'complete-bss-partitions'
+METADATA_FILENAME = '_metadata.json'
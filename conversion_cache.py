@@ -0,0 +1,145 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import pandas as pd
+
+import column_conversions
+import distances
+import ingest
+
+CACHE_DIR = '.conversion-cache'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+HASHES_FILENAME = 'file-hashes.json'
+ENTRY_SUFFIX = '.pkl'
+HASH_BUFFER_SIZE = 1024 * 1024
+CACHE_VERSION = 1 # bump to drop every entry, e.g. when the entry layout changes
+
+# Converted files are kept as a pickle stream of their frames (one pickle per chunk), which loads faster than any other
+# format pandas has and keeps the index and dtypes exactly, without needing pyarrow. An entry is named after the md5 of
+# the input file's content plus a fingerprint of everything the conversion depends on: all of column_conversions.py (the
+# Converter classes, subscriber schemes, source and final dtypes and formats), the city's conversions, the distance and
+# csv reading code, the conversion options and the pandas version. Any edit to those files invalidates every city. File
+# hashes are remembered by size and mtime so unchanged files aren't read again.
+def file_md5(path):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(HASH_BUFFER_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def converter_fingerprint(converter, distance_method, compact, engine='c'):
+    parts = [str(CACHE_VERSION), pd.__version__, distance_method, str(compact), engine] # pickles don't always load in other pandas versions
+    parts += [inspect.getsource(column_conversions), inspect.getsource(distances), inspect.getsource(ingest)]
+    parts += [inspect.getsource(cls) for cls in type(converter).__mro__ if cls is not object and cls.__module__ != column_conversions.__name__]
+    parts += [repr(sorted(converter.conversions.items())), repr(sorted(converter.no_info_list))]
+    return hashlib.md5('\n'.join(parts).encode('utf-8')).hexdigest()
+
+class ConversionCache():
+    def __init__(self, directory=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.fingerprints = {}
+        self.hashes_path = os.path.join(directory, HASHES_FILENAME)
+        self.file_hashes = self.load_hashes()
+
+    def load_hashes(self):
+        if not os.path.isfile(self.hashes_path):
+            return {}
+        try:
+            with open(self.hashes_path) as hashes_file:
+                return json.load(hashes_file)
+        except ValueError:
+            print('[WARN] ignoring unreadable {}'.format(self.hashes_path))
+            return {}
+
+    def get_file_hash(self, path):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        known = self.file_hashes.get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['md5']
+        md5 = file_md5(path)
+        self.file_hashes[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': md5}
+        return md5
+
+    def get_key(self, path, city, distance_method, compact=False, engine='c'):
+        fingerprint_key = (city, distance_method, compact, engine)
+        if fingerprint_key not in self.fingerprints:
+            self.fingerprints[fingerprint_key] = converter_fingerprint(column_conversions.CONVERTERS[city], distance_method, compact, engine)
+        return '{}-{}'.format(self.get_file_hash(path), self.fingerprints[fingerprint_key])
+
+    def get_entry_path(self, city, key):
+        return os.path.join(self.directory, city, key + ENTRY_SUFFIX)
+
+    def load(self, city, key):
+        # the cached frames as a generator, or None if there's no entry
+        entry_path = self.get_entry_path(city, key)
+        try:
+            os.utime(entry_path) # eviction drops the least recently used entries first
+            entry_file = open(entry_path, 'rb') # opened now, so the entry can still be read if it's evicted meanwhile
+        except FileNotFoundError: # never stored, or evicted by another process
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.iter_entry(entry_file)
+
+    def iter_entry(self, entry_file):
+        with entry_file:
+            while True:
+                try:
+                    yield pickle.load(entry_file)
+                except EOFError:
+                    return
+
+    def store(self, city, key, frames):
+        # passes the frames through while writing them, so chunked conversions are still never held whole. The entry only
+        # appears once the last frame is written
+        entry_path = self.get_entry_path(city, key)
+        temp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        try:
+            with open(temp_path, 'wb') as entry_file:
+                for frame in frames:
+                    pickle.dump(frame, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield frame
+            os.replace(temp_path, entry_path)
+        finally:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(ENTRY_SUFFIX):
+                    try:
+                        stat = os.stat(os.path.join(root, filename))
+                    except FileNotFoundError: # another process evicted it
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+        total_bytes = sum([size for _, size, _ in entries])
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def save(self):
+        self.evict()
+        os.makedirs(self.directory, exist_ok=True)
+        file_hashes = self.load_hashes() # keeps hashes another process saved since these were loaded
+        file_hashes.update(self.file_hashes)
+        self.file_hashes = file_hashes
+        temp_path = '{}.{}.tmp'.format(self.hashes_path, os.getpid())
+        with open(temp_path, 'w') as hashes_file:
+            json.dump(self.file_hashes, hashes_file)
+        os.replace(temp_path, self.hashes_path)
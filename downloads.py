@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from instrumentation import stage
+from retries import NO_RETRIES, get_status_code, with_retries
+
+COPY_BUFFER_SIZE = 1024 * 1024 # bytes read from the socket per write
+REQUEST_TIMEOUT = 60 # seconds to wait for a connection or the next block of bytes
+PART_SUFFIX = '.part' # downloads are written here first and renamed once complete
+CHUNKS_SUFFIX = '.chunks' # next to a ranged .part file, lists the byte ranges already written
+ETAG_SUFFIX = '.etag' # next to a streamed .part file, the ETag of the object it holds the start of
+
+DownloadJob = namedtuple('DownloadJob', ['key', 'url', 'path', 'size', 'etag'])
+DownloadOptions = namedtuple('DownloadOptions', ['chunk_size', 'chunk_workers', 'retry_policy', 'verify', 'quarantine_dir'])
+
+def make_session(max_connections_per_host):
+    # pool_block keeps at most max_connections_per_host sockets open to any host. Extra workers wait for a free connection
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max_connections_per_host, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class ByteProgress():
+    def __init__(self, total_bytes):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.bar = tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1000)
+
+    def update(self, byte_count):
+        with self.lock:
+            self.bar.update(byte_count)
+
+    def close(self):
+        self.bar.close()
+
+class JobProgress():
+    # counts the bytes of one download so a retried attempt can take its bytes back off the shared bar
+    def __init__(self, progress):
+        super().__init__()
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.byte_count = 0
+
+    def update(self, byte_count):
+        with self.lock:
+            self.byte_count += byte_count
+        self.progress.update(byte_count)
+
+    def reset(self):
+        with self.lock:
+            byte_count, self.byte_count = self.byte_count, 0
+        self.progress.update(-byte_count)
+
+def download_file(session, job, progress, options):
+    part_path = job.path + PART_SUFFIX
+    if options.chunk_size and job.size > options.chunk_size and supports_ranges(session, job.url):
+        byte_count, digest = download_ranged(session, job, part_path, progress, options.chunk_size, options.chunk_workers), None
+    else:
+        byte_count, digest = download_stream(session, job, part_path, progress, options.verify)
+    if options.verify:
+        verify_download(job, part_path, byte_count, digest, options.quarantine_dir)
+    os.replace(part_path, job.path)
+    remove_part_etag(part_path)
+
+def supports_ranges(session, url):
+    with session.head(url, timeout=REQUEST_TIMEOUT) as response:
+        return response.ok and response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+def hash_existing(path, hasher):
+    with open(path, 'rb') as part_file:
+        for block in iter(lambda: part_file.read(COPY_BUFFER_SIZE), b''):
+            hasher.update(block)
+
+def read_part_etag(part_path):
+    etag_path = part_path + ETAG_SUFFIX
+    if not os.path.isfile(etag_path):
+        return None
+    with open(etag_path) as etag_file:
+        return etag_file.read()
+
+def write_part_etag(part_path, etag):
+    with open(part_path + ETAG_SUFFIX, 'w') as etag_file:
+        etag_file.write(etag or '')
+
+def remove_part_etag(part_path):
+    if os.path.isfile(part_path + ETAG_SUFFIX):
+        os.remove(part_path + ETAG_SUFFIX)
+
+def get_range_headers(job, start, end=''):
+    # If-Range makes the server send the whole object (200) instead of the range once the ETag changed, so bytes of
+    # two versions of an object are never joined together
+    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+    if job.etag:
+        headers['If-Range'] = '"{}"'.format(job.etag)
+    return headers
+
+def download_stream(session, job, part_path, progress, verify):
+    hasher = hashlib.md5() if verify and is_md5_etag(job.etag) else None
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset > 0 and (os.path.isfile(part_path + CHUNKS_SUFFIX) or read_part_etag(part_path) != (job.etag or '')):
+        # written by a ranged download or for another version of the object, so it can't be resumed
+        os.remove(part_path)
+        offset = 0
+    if offset > 0 and offset == job.size:
+        if hasher is not None:
+            hash_existing(part_path, hasher)
+        progress.update(offset)
+        return offset, hasher.hexdigest() if hasher is not None else None
+    response = None
+    if offset > 0:
+        response = session.get(job.url, headers=get_range_headers(job, offset), stream=True, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 416: # the .part file doesn't fit the object anymore
+            response.close() # gives the connection back to the pool before asking for the whole object
+            os.remove(part_path)
+            offset = 0
+    if offset == 0:
+        write_part_etag(part_path, job.etag)
+        response = session.get(job.url, stream=True, timeout=REQUEST_TIMEOUT)
+    with response:
+        response.raise_for_status()
+        if response.status_code != 206: # server ignored the Range header or the object changed, and it's sending the whole object
+            offset = 0
+        if offset > 0 and hasher is not None:
+            hash_existing(part_path, hasher) # only the resumed prefix is read back, new bytes are hashed as they arrive
+        progress.update(offset)
+        byte_count = offset
+        with open(part_path, 'ab' if offset > 0 else 'wb') as out_file:
+            for block in response.iter_content(COPY_BUFFER_SIZE):
+                out_file.write(block)
+                if hasher is not None:
+                    hasher.update(block)
+                byte_count += len(block)
+                progress.update(len(block))
+    return byte_count, hasher.hexdigest() if hasher is not None else None
+
+## Integrity Checks
+# The ETag of an object uploaded in one part is the MD5 of its bytes. Multipart ETags look like '<md5>-<part count>'
+# and can't be recomputed from the file, so those objects (and ranged downloads, which aren't hashed) only get the size check.
+def is_md5_etag(etag):
+    return etag is not None and re.fullmatch('[0-9a-f]{32}', etag) is not None
+
+def verify_download(job, part_path, byte_count, digest, quarantine_dir):
+    problem = None
+    if job.size > 0 and byte_count != job.size:
+        problem = "got {} bytes but the listing says {}".format(byte_count, job.size)
+    elif digest is not None and digest != job.etag:
+        problem = "MD5 {} doesn't match ETag {}".format(digest, job.etag)
+    if problem is None:
+        return
+    # a bad .part can't be resumed, so move it out of the way and let the retry start from zero
+    if quarantine_dir:
+        os.makedirs(quarantine_dir, exist_ok=True)
+        shutil.move(part_path, os.path.join(quarantine_dir, os.path.basename(job.path)))
+    else:
+        os.remove(part_path)
+    raise RuntimeError("Integrity check failed for {}: {}".format(job.key, problem))
+
+## Ranged Downloads
+# Large objects are split into chunk_size byte ranges fetched in parallel and written in place into a pre-allocated
+# .part file. The .chunks file records finished ranges so an interrupted download only refetches the missing ones.
+def get_chunks_header(job, chunk_size):
+    return {'chunk_size': chunk_size, 'size': job.size, 'etag': job.etag}
+
+def load_finished_chunks(chunks_path, header):
+    if not os.path.isfile(chunks_path):
+        return set()
+    with open(chunks_path) as chunks_file:
+        lines = chunks_file.read().splitlines()
+    if len(lines) == 0 or json.loads(lines[0]) != header: # another chunk size or another version of the object
+        return None
+    return set([int(line) for line in lines[1:] if len(line) > 0])
+
+def write_at(fd, block, offset, lock):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, block, offset)
+    else:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, block)
+
+def download_chunk(session, job, fd, start, end, progress, lock):
+    with session.get(job.url, headers=get_range_headers(job, start, end), stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RuntimeError("Server ignored the byte range {}-{} for {} or the object changed".format(start, end, job.key))
+        offset = start
+        for block in response.iter_content(COPY_BUFFER_SIZE):
+            write_at(fd, block, offset, lock)
+            offset += len(block)
+            progress.update(len(block))
+    if offset != end + 1:
+        raise RuntimeError("Byte range {}-{} of {} ended early at {}".format(start, end, job.key, offset))
+
+def download_ranged(session, job, part_path, progress, chunk_size, chunk_workers):
+    chunks_path = part_path + CHUNKS_SUFFIX
+    header = get_chunks_header(job, chunk_size)
+    finished = load_finished_chunks(chunks_path, header)
+    if finished is None or not os.path.isfile(part_path):
+        finished = set()
+        with open(chunks_path, 'w') as chunks_file:
+            chunks_file.write(json.dumps(header) + '\n')
+    starts = [start for start in range(0, job.size, chunk_size) if start not in finished]
+    progress.update(job.size - sum([min(chunk_size, job.size - start) for start in starts]))
+
+    lock = threading.Lock()
+    with open(part_path, 'r+b' if os.path.isfile(part_path) else 'w+b') as part_file:
+        part_file.truncate(job.size)
+        fd = part_file.fileno()
+        with ThreadPoolExecutor(max_workers=chunk_workers) as executor, open(chunks_path, 'a') as chunks_file:
+            futures = {executor.submit(download_chunk, session, job, fd, start, min(start + chunk_size, job.size) - 1, progress, lock): start for start in starts}
+            for future in as_completed(futures):
+                future.result()
+                chunks_file.write('{}\n'.format(futures[future]))
+                chunks_file.flush()
+        os.fsync(fd)
+        byte_count = os.fstat(fd).st_size
+    os.remove(chunks_path)
+    return byte_count
+
+def download_with_retries(session, job, progress, options):
+    job_progress = JobProgress(progress)
+    with stage('download.file', key=job.key) as download_stage:
+        with_retries(options.retry_policy, job.key, download_file, session, job, job_progress, options, on_retry=job_progress.reset)
+        download_stage.add(rows=1, bytes=max(job.size, 0))
+
+def download_all(jobs, workers=1, max_connections_per_host=None, on_complete=None, chunk_size=None, chunk_workers=1, retry_policy=NO_RETRIES,
+        verify=True, quarantine_dir=None):
+    options = DownloadOptions(chunk_size, chunk_workers, retry_policy, verify, quarantine_dir)
+    if max_connections_per_host is None:
+        max_connections_per_host = max(workers, chunk_workers)
+    completed = []
+    failed = []
+    session = make_session(max_connections_per_host)
+    progress = ByteProgress(sum([max(job.size, 0) for job in jobs]))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(download_with_retries, session, job, progress, options): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    future.result()
+                    completed.append(job)
+                    if on_complete is not None:
+                        on_complete(job)
+                except Exception as e:
+                    tqdm.write("[WARN] Encountered exception while downloading {}: {}".format(job.path, e))
+                    failed.append((job, e))
+    finally:
+        progress.close()
+        session.close()
+    return completed, failed
+
+## Failure Reports
+# JSON-lines, one failed download per line. A later run can pass the report back to only fetch those keys again.
+def write_failure_report(failures, path):
+    with open(path, 'w') as report_file:
+        for job, error in failures:
+            entry = {'key': job.key, 'url': job.url, 'path': job.path, 'size': job.size, 'attempts': getattr(error, 'attempts', 1),
+                'status_code': get_status_code(error), 'error': '{}: {}'.format(type(error).__name__, error)}
+            report_file.write(json.dumps(entry) + '\n')
+
+def load_failure_report(path):
+    with open(path) as report_file:
+        return set([json.loads(line)['key'] for line in report_file if len(line.strip()) > 0])
@@ -1,29 +1,73 @@
 from argparse import ArgumentParser
 import re
-import requests
-import xml.etree.ElementTree as ET
-import urllib.request
 import os
-import shutil
 import zipfile
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from downloads import DownloadJob, download_all, write_failure_report, load_failure_report
+from retries import RetryPolicy
+import instrumentation
+from unzipper import extract_archive
+from listing_snapshots import SNAPSHOT_FILENAME, DEFAULT_TTL_HOURS, ListingSnapshots, list_bucket_with_snapshots, is_in_date_range
+from s3_listing import list_bucket
+from sync_manifest import MANIFEST_FILENAME, load_manifest, save_manifest, append_manifest_entries, manifest_entry, is_up_to_date
 
 ## Argument Parsing
 parser = ArgumentParser()
 parser.add_argument("url", help="Bucket URL (show's an XML file in your browser).") 
 parser.add_argument("-D", dest="should_download", required=False, action="store_true", default=False, help="If turned on, downloads files to the current directory. Otherwise, filenames and sizes are printed only.")
 parser.add_argument("--dir", required=False, default="./", help="Directory to save downloads.")
-parser.add_argument("--max-filesize-KB", "-m", type=int, required=False, default=1000, help="Maximum file size for each download in KiloBytes. Default is 1000 KB.")
+parser.add_argument("--max-filesize-KB", "-m", type=int, required=False, default=1000, help="Maximum file size for each download in KiloBytes. Default is 1000 KB. Use 0 for no limit.")
 parser.add_argument("--download-capacity", "-c", type=int, required=False, default=250, help="Maximum number of MegaBytes for total download (sum of all files). Default is 250 MB.")
 parser.add_argument("--filetypes", "-t", required=False, help="Comma-separated file types to include (leave out the '.')")
 parser.add_argument("--filename-pattern", "-p", required=False, help="Regular expression for filenames to include. Doesn't need to match the whole entire filename, just part of it.")
 parser.add_argument("--verbose", "-v", required=False, action="store_true", default=False, help="Prints files found but not matched.")
 parser.add_argument("--silence-large-files", "-s", required=False, action="store_true", default=False, help="Silences printing of matched files with unknown or to large a size.")
+parser.add_argument("--workers", "-w", type=int, required=False, default=1, help="Number of files to download at the same time. Default is 1 (one file after another).")
+parser.add_argument("--prefix", required=False, help="Only list keys starting with this prefix (filtered by the bucket, so the rest of the bucket isn't scanned).")
+parser.add_argument("--delimiter", required=False, help="Groups keys sharing a prefix up to this character (e.g. '/') so they aren't listed one by one.")
+parser.add_argument("--list-type", type=int, choices=[1, 2], required=False, default=1, help="ListObjects API version used to page through the bucket. Default is 1.")
+parser.add_argument("--max-connections-per-host", type=int, required=False, help="Maximum number of open connections to the bucket's host. Defaults to the number of workers.")
+parser.add_argument("--chunk-size-MB", type=int, required=False, default=64, help="Files bigger than this are downloaded as parallel byte ranges when the server supports it. Default is 64 MB. Use 0 to always download files in one stream.")
+parser.add_argument("--chunk-workers", type=int, required=False, default=4, help="Number of byte ranges of one file downloaded at the same time. Default is 4.")
+parser.add_argument("--retries", type=int, required=False, default=3, help="Number of times a failed download is retried (throttling, server errors, dropped connections). Default is 3.")
+parser.add_argument("--backoff", type=float, required=False, default=1.0, help="Base delay in seconds between retries. Doubles after every retry and is randomized (jitter). Default is 1 second.")
+parser.add_argument("--max-backoff", type=float, required=False, default=60.0, help="Longest delay in seconds between retries, including delays asked for by a Retry-After header. Default is 60 seconds.")
+parser.add_argument("--failure-report", required=False, default="failed-downloads.jsonl", help="JSON-lines file (inside --dir) listing downloads that still failed after all retries. Default is failed-downloads.jsonl.")
+parser.add_argument("--retry-failed", required=False, help="Failure report from an earlier run. Only the keys listed in it are downloaded.")
+parser.add_argument("--no-verify", dest="verify", required=False, action="store_false", default=True, help="Skips checking each download's size and MD5 against the listing's Size and ETag.")
+parser.add_argument("--quarantine-dir", required=False, help="Directory where downloads that fail the size or MD5 check are moved before retrying. By default they are deleted.")
+parser.add_argument("--extract", "-x", required=False, action="store_true", default=False, help="Extracts each .zip as soon as it's downloaded, while the other downloads keep going, and deletes the archive afterwards.")
+parser.add_argument("--extract-workers", type=int, required=False, default=2, help="Number of archives extracted at the same time with --extract. Default is 2.")
+parser.add_argument("--extract-pattern", required=False, help="With --extract, only extracts archive members matching this regular expression (e.g. '\\.csv$').")
+parser.add_argument("--keep-archives", required=False, action="store_true", default=False, help="With --extract, keeps each .zip after extracting it.")
+parser.add_argument("--sync", required=False, action="store_true", default=False, help="Only downloads files that are new or changed since the last sync (tracked in {} inside --dir). Changed files are overwritten instead of renamed.".format(MANIFEST_FILENAME))
+parser.add_argument("--snapshot-db", required=False, default=SNAPSHOT_FILENAME, help="SQLite file where bucket listings are kept, so dry runs can be filtered again without listing the bucket. Default is {} in the current directory.".format(SNAPSHOT_FILENAME))
+parser.add_argument("--snapshot-ttl-hours", type=float, required=False, default=DEFAULT_TTL_HOURS, help="Dry runs reuse a listing younger than this. Downloads (-D) always list the bucket again. Default is %(default)s hours.")
+parser.add_argument("--refresh", required=False, action="store_true", default=False, help="Lists the bucket again instead of using a listing snapshot.")
+parser.add_argument("--offline", required=False, action="store_true", default=False, help="Only uses listing snapshots, whatever their age, and never lists the bucket.")
+parser.add_argument("--no-snapshot", required=False, action="store_true", default=False, help="Lists the bucket without reading or writing listing snapshots.")
+parser.add_argument("--modified-after", required=False, help="Only includes files last modified on or after this date or time (e.g. 2020-01-01 or 2020-01-01T12:00).")
+parser.add_argument("--modified-before", required=False, help="Only includes files last modified before this date or time.")
+parser.add_argument("--delete-removed", required=False, action="store_true", default=False, help="With --sync, deletes local files whose keys were removed from the bucket.")
 
+instrumentation.add_arguments(parser)
 args = parser.parse_args()
+instrumentation.configure_from_args(args)
 print("Arguments:")
 print(args)
 print()
+if args.delete_removed and not args.sync:
+    parser.error("--delete-removed only works with --sync")
+if args.offline and (args.refresh or args.no_snapshot):
+    parser.error("--offline can't be used with --refresh or --no-snapshot")
+if args.delete_removed and (args.modified_after or args.modified_before):
+    parser.error("--delete-removed can't be used with --modified-after or --modified-before, since files outside the dates would count as removed")
+download_dir = os.path.abspath(args.dir)
+failure_report_path = os.path.join(download_dir, args.failure_report)
+retry_report_path = os.path.abspath(args.retry_failed) if args.retry_failed else None
+retry_keys = load_failure_report(retry_report_path) if retry_report_path else None
+manifest_path = os.path.join(download_dir, MANIFEST_FILENAME)
+snapshots = ListingSnapshots(os.path.abspath(args.snapshot_db)) if not args.no_snapshot else None
 if args.should_download:
     if not os.path.isdir(args.dir):
         os.mkdir(args.dir)
@@ -42,63 +86,72 @@ filename_regexes = [re.compile(regex_string) for regex_string in filename_regex_
 print("Filename regular expressions: {}".format(filename_regex_strings))
 
 def is_good_filename(filename):
+    if retry_keys is not None and filename not in retry_keys:
+        return False
     return any([filename_regex.match(filename) is not None for filename_regex in filename_regexes])
 
-## Looping through XML Tree
-def trim_xml_tag(tag):
-    right_bracket = tag.find("}")
-    return tag[right_bracket+1:]
-
+## Listing the Bucket
 # url = "https://s3.amazonaws.com/biketown-tripdata-public"
-result = requests.get(args.url)
-status_message = "HTTP GET status code: {}".format(result.status_code)
-if result.status_code != 200:
-    raise RuntimeError(status_message)
-print(status_message)
-print()
-
 matched_files = []
 large_files = []
 unmatched_files = []
+common_prefixes = []
+listed_keys = set()
 found_files = False
-try:
-    root = ET.fromstring(result.text)
-except ET.ParseError:
-    raise RuntimeError("Couldn't parse the URL content as XML")
-for child in root:
-    if trim_xml_tag(child.tag) == "Contents":
-        filename = ""
-        filesize = -1
-        haveFilename = False
-        haveFilesize = False
-        for grandchild in child:
-            trimmed_tag = trim_xml_tag(grandchild.tag)
-            if not haveFilename and trimmed_tag == "Key":
-                filename = grandchild.text
-            if not haveFilesize and trimmed_tag == "Size":
-                filesize = int(grandchild.text)
-            haveFilename = len(filename) > 0
-            haveFilesize = filesize > 0
-            if haveFilename and haveFilesize:
-                break
-
-        if haveFilename:
-            found_files = True
-            fileBundle = (filename, filesize)
-            if is_good_filename(filename):
-                if haveFilesize and filesize < args.max_filesize_KB * 1000:
-                    matched_files.append(fileBundle)
-                else:
-                    large_files.append(fileBundle)
-            elif args.verbose:
-                unmatched_files.append(fileBundle)
+if snapshots is not None:
+    # downloads need current sizes and ETags, so only dry runs reuse a snapshot unless --offline is given
+    refresh = args.refresh or (args.should_download and not args.offline)
+    records = list_bucket_with_snapshots(args.url, snapshots, args.prefix, args.delimiter, args.list_type, common_prefixes,
+        args.snapshot_ttl_hours * 3600, refresh, args.offline, args.modified_after, args.modified_before)
+else:
+    records = (record for record in list_bucket(args.url, prefix=args.prefix, delimiter=args.delimiter, list_type=args.list_type, common_prefixes=common_prefixes)
+        if is_in_date_range(record, args.modified_after, args.modified_before))
+with instrumentation.stage('list', url=args.url) as list_stage:
+    for record in records:
+        found_files = True
+        list_stage.add(rows=1)
+        if args.delete_removed:
+            listed_keys.add(record.key)
+        if is_good_filename(record.key):
+            if record.size > 0 and (args.max_filesize_KB == 0 or record.size < args.max_filesize_KB * 1000):
+                matched_files.append(record)
+            else:
+                large_files.append(record)
+        elif args.verbose:
+            unmatched_files.append(record)
+if snapshots is not None:
+    snapshots.close()
+
+## Incremental Sync
+up_to_date_count = 0
+if args.sync:
+    manifest = load_manifest(manifest_path)
+    changed_files = [record for record in matched_files if not is_up_to_date(record, manifest.get(record.key), download_dir)]
+    up_to_date_count = len(matched_files) - len(changed_files)
+    matched_files = changed_files
+    print("{} matched files are already up to date in {}".format(up_to_date_count, download_dir))
+
+    # keys outside the listed prefix weren't listed, so they can't count as removed
+    removed_keys = [key for key in manifest.keys() if key.startswith(args.prefix or "") and key not in listed_keys] if args.delete_removed else []
+    if len(removed_keys) > 0:
+        print("{} files were removed from the bucket{}:".format(len(removed_keys), "" if args.should_download else " (run with -D to delete them locally)"))
+        for key in removed_keys:
+            print(manifest[key]['filename'])
+            if args.should_download:
+                local_path = os.path.join(download_dir, manifest[key]['filename'])
+                if os.path.isfile(local_path):
+                    os.remove(local_path)
+                del manifest[key]
+        if args.should_download:
+            save_manifest(manifest, manifest_path)
+    print()
 
 ## Print Information about Results
 def bytes_to_MB(count):
     return round(count / 1000 / 1000, 2)
 
 def get_total_size(bundles):
-    return bytes_to_MB(sum([size for _, size in bundles]))
+    return bytes_to_MB(sum([bundle.size for bundle in bundles]))
     
 total_download_size = get_total_size(matched_files)
 over_capacity = total_download_size > args.download_capacity
@@ -106,7 +159,7 @@ if over_capacity:
     raise RuntimeError("Prevented download of {} files since their combined size is {} MB. Capacity set to {} MB.".format(len(matched_files), total_download_size, args.download_capacity))
 
 def print_file_bundle(bundle):
-    name, size = bundle
+    name, size = bundle.key, bundle.size
     size = -1 if size == -1 else bytes_to_MB(size) 
     print("{:25} | {:8} MB".format(name, size))
 
@@ -117,6 +170,8 @@ if len(matched_files) > 0:
     print()
 elif not found_files:
     print("Couldn't find files at {}".format(args.url))
+elif up_to_date_count > 0:
+    print("No new or changed files to download.")
 elif not len(large_files) > 0:
     print("No files matched the criteria.")
 
@@ -126,6 +181,12 @@ if len(large_files) > 0 and not args.silence_large_files:
         print_file_bundle(bundle)
     print()
 
+if args.verbose and len(common_prefixes) > 0:
+    print("{} common prefixes were grouped by the delimiter: ".format(len(common_prefixes)))
+    for prefix in common_prefixes:
+        print(prefix)
+    print()
+
 if args.verbose and len(unmatched_files) > 0:
     print("{} files were not matched. They had a combined size of {} MB: ".format(len(unmatched_files), get_total_size(unmatched_files)))
     for bundle in unmatched_files:
@@ -153,29 +214,69 @@ def get_good_filename(name):
 
 if args.should_download and len(matched_files) > 0:
     print("Beginning Downloads")
-    failed_downloads = []
     clean_url = args.url
     if clean_url[-1] != "/":
         clean_url += "/"
-    for name, size in tqdm(matched_files):
-        download_url = clean_url + name
+    jobs = []
+    for name, size, etag, _ in matched_files:
+        if args.sync:
+            jobs.append(DownloadJob(name, clean_url + name, name, size, etag))
+            continue
         good_name, extension = get_good_filename(name)
         if not good_name:
             print("Couldn't download {} because the file and similar names for it already exist.".format(name))
             continue
         if good_name != name:
             print("{} already exists. Renaming downloaded file to {}".format(name, good_name))
-        try:
-            with urllib.request.urlopen(download_url) as response, open(good_name, 'wb') as out_file:
-                shutil.copyfileobj(response, out_file)
-        except Exception as e:
-            print("[WARN] Encountered exception while downloading {}: {}".format(good_name, e))
-            
+        jobs.append(DownloadJob(name, clean_url + name, good_name, size, etag))
+    records_by_key = {record.key: record for record in matched_files}
+    extract_executor = ThreadPoolExecutor(max_workers=args.extract_workers) if args.extract else None
+    extract_regex = re.compile(args.extract_pattern) if args.extract_pattern else None
+    extractions = {}
+    def record_download(job):
+        if args.sync:
+            append_manifest_entries([manifest_entry(records_by_key[job.key], job.path)], manifest_path)
+        if extract_executor is not None and job.path.endswith(".zip"):
+            extractions[job] = extract_executor.submit(extract_archive, job.path, os.path.dirname(job.path) or ".", extract_regex, not args.keep_archives)
+    with instrumentation.stage('download') as download_stage:
+        completed, failures = download_all(jobs, workers=args.workers, max_connections_per_host=args.max_connections_per_host, on_complete=record_download,
+            chunk_size=args.chunk_size_MB * 1000 * 1000, chunk_workers=args.chunk_workers, retry_policy=RetryPolicy(args.retries + 1, args.backoff, args.max_backoff),
+            verify=args.verify, quarantine_dir=os.path.join(download_dir, args.quarantine_dir) if args.quarantine_dir else None)
+        download_stage.add(rows=len(completed), bytes=sum([max(job.size, 0) for job in completed]))
+
+    if extract_executor is not None:
+        with instrumentation.stage('extract.wait'): # extractions still running after the last download
+            extract_executor.shutdown(wait=True)
+        failed_extractions = []
+        for job, future in extractions.items():
+            try:
+                future.result()
+            except Exception as e:
+                print("[WARN] Encountered exception while extracting {}: {}".format(job.path, e))
+                failed_extractions.append(job.path)
+                continue
+            if args.sync:
+                # the archive may be gone now, so the manifest marks it as extracted instead of checking the file
+                append_manifest_entries([dict(manifest_entry(records_by_key[job.key], job.path), extracted=True)], manifest_path)
+        print("Extracted {} of {} archives.".format(len(extractions) - len(failed_extractions), len(extractions)))
+        if len(failed_extractions) > 0:
+            print("Failed Extractions: ")
+            for path in failed_extractions:
+                print(path)
+        print()
+
+    if args.sync:
+        save_manifest(load_manifest(manifest_path), manifest_path)
+    failed_downloads = [job.path for job, _ in failures]
+
     if len(failed_downloads) > 0:
-        failed_downloads.append(good_name)
-        print("Failed Downloads: ")
+        write_failure_report(failures, failure_report_path)
+        print("Failed Downloads (written to {}, rerun with --retry-failed {} to fetch only these): ".format(failure_report_path, failure_report_path))
         for download in failed_downloads:
             print(download)
         print()
         print("Failed Downloads regex: {}".format("|".join(["({})".format(filename) for filename in failed_downloads])))
+    elif retry_report_path == failure_report_path and os.path.isfile(failure_report_path):
+        os.remove(failure_report_path) # every download from the report went through
     print("Done downloading.")
+instrumentation.finish()
@@ -0,0 +1,42 @@
+import pandas as pd
+
+from column_conversions import CITIES, CONVERTERS
+from constants import CSV_ENGINES
+
+# Monthly trip files have up to 15 columns (bike ids, station ids and names, ride ids) and each city's conversion only
+# uses the handful named in its conversions and extra_source_columns. Only those are parsed, with the dtypes from
+# SOURCE_DTYPES, so the parser skips the rest of every line and doesn't infer types. The header is read first since
+# cities have changed their columns over the years. The pyarrow engine parses with several threads and reads the same
+# columns into the same dtypes, but can't read a file in chunks. Its float parsing is exact, like pandas'
+# float_precision='round_trip', where the default c parser is sometimes off in the last digit, so coordinates (and the
+# distances computed from them) can differ from the c engine's in about the 16th significant digit.
+def read_header(path):
+    return list(pd.read_csv(path, nrows=0).columns)
+
+def get_read_options(path, city):
+    dtypes = CONVERTERS[city].get_source_dtypes(read_header(path))
+    return {
+        'usecols': list(dtypes.keys()),
+        'dtype': {column: dtype for column, dtype in dtypes.items() if dtype is not None},
+    }
+
+def read_with_pyarrow(path, options):
+    # pyarrow.csv directly, since pandas' pyarrow engine infers types first (e.g. datetimes) and casts afterwards
+    import pyarrow as pa
+    from pyarrow import csv
+    column_types = {column: pa.string() if dtype is str else pa.type_for_alias(dtype) for column, dtype in options['dtype'].items()}
+    convert_options = csv.ConvertOptions(include_columns=options['usecols'], column_types=column_types, strings_can_be_null=True) # '' is missing, as in pandas
+    return csv.read_csv(path, convert_options=convert_options).to_pandas(split_blocks=True, self_destruct=True) # frees each column's arrow buffer as it's converted
+
+def read_trips(path, city, chunksize=None, engine='c'):
+    # the file as one frame, or an iterator of frames of chunksize rows
+    if city not in CITIES:
+        raise ValueError('{} is not a valid city'.format(city))
+    if engine not in CSV_ENGINES:
+        raise ValueError('{} is not a valid csv engine'.format(engine))
+    options = get_read_options(path, city)
+    if engine == 'pyarrow':
+        if chunksize:
+            raise ValueError("the pyarrow engine can't read a file in chunks")
+        return read_with_pyarrow(path, options)
+    return pd.read_csv(path, chunksize=chunksize, **options)
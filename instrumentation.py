@@ -0,0 +1,240 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+FORMATS = ['jsonl', 'prometheus']
+# settings go through the environment so worker processes (process pools, subprocesses) record to the same place
+METRICS_PATH_ENV = 'BSS_METRICS_PATH'
+METRICS_FORMAT_ENV = 'BSS_METRICS_FORMAT'
+PROFILE_ENV = 'BSS_PROFILE'
+TRACE_MEMORY_ENV = 'BSS_TRACE_MEMORY'
+PROFILE_DIR_ENV = 'BSS_PROFILE_DIR'
+EVENTS_SUFFIX = '.events.jsonl'
+TOP_ALLOCATIONS = 10
+PROMETHEUS_PREFIX = 'bss'
+
+# Every stage and sub-step of the pipeline runs inside stage(name, **labels). With --metrics, each one appends a JSON line
+# with its wall time, the rows/bytes it reported through add(), the throughput and the process's peak RSS so far. In
+# prometheus format those lines go to {path}.events.jsonl and finish() sums them per stage into a textfile for the node
+# exporter's textfile collector. --profile and --trace-memory take stage names (or name prefixes) to run under cProfile
+# or tracemalloc. Without any of these a stage only costs a function call.
+_lock = threading.Lock()
+_profile_counter = [0]
+_profiler_active = [False] # only one cProfile profiler can run at a time, so stages nested in a profiled one aren't profiled again
+# tracemalloc is process-wide, so traced stages running in different threads share it. The last one to finish stops it,
+# and only if a stage started it
+_tracing_count = [0]
+_started_tracing = [False]
+
+def get_settings():
+    return {
+        'path': os.environ.get(METRICS_PATH_ENV),
+        'format': os.environ.get(METRICS_FORMAT_ENV, 'jsonl'),
+        'profile': [name for name in os.environ.get(PROFILE_ENV, '').split(',') if len(name) > 0],
+        'trace_memory': [name for name in os.environ.get(TRACE_MEMORY_ENV, '').split(',') if len(name) > 0],
+        'profile_dir': os.environ.get(PROFILE_DIR_ENV, '.'),
+    }
+
+_settings = get_settings()
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", required=False, help="File that gets the wall time, rows/bytes, throughput and peak memory of every stage.")
+    parser.add_argument("--metrics-format", choices=FORMATS, required=False, default="jsonl", help="jsonl appends one line per stage run. prometheus writes per-stage totals for the node exporter's textfile collector. Default is jsonl.")
+    parser.add_argument("--profile", required=False, help="Comma-separated stage names (or prefixes, e.g. 'convert') to run under cProfile. Writes {stage}-{pid}-{n}.prof files to --profile-dir.")
+    parser.add_argument("--trace-memory", required=False, help="Comma-separated stage names (or prefixes) to run under tracemalloc. Their traced peak and top allocations are added to the metrics.")
+    parser.add_argument("--profile-dir", required=False, default=".", help="Where --profile writes its files. Default is the current directory.")
+
+def configure(metrics_path=None, metrics_format='jsonl', profile=None, trace_memory=None, profile_dir='.'):
+    global _settings
+    if metrics_format not in FORMATS:
+        raise ValueError('{} is not a valid metrics format'.format(metrics_format))
+    settings = {
+        METRICS_PATH_ENV: os.path.abspath(metrics_path) if metrics_path else None,
+        METRICS_FORMAT_ENV: metrics_format,
+        PROFILE_ENV: profile,
+        TRACE_MEMORY_ENV: trace_memory,
+        PROFILE_DIR_ENV: os.path.abspath(profile_dir) if profile_dir else None,
+    }
+    for name, value in settings.items():
+        if value:
+            os.environ[name] = value
+        else:
+            os.environ.pop(name, None)
+    _settings = get_settings()
+    if _settings['path'] and _settings['format'] == 'prometheus' and os.path.isfile(get_events_path()):
+        os.remove(get_events_path()) # the textfile describes this run only
+
+def configure_from_args(args):
+    configure(args.metrics, args.metrics_format, args.profile, args.trace_memory, args.profile_dir)
+
+def get_arguments():
+    # flags that make another script, run as a subprocess, record its stages to this run's events. finish() here still
+    # writes the prometheus textfile, so the subprocess appends plain events
+    arguments = []
+    if _settings['path']:
+        arguments += ['--metrics', get_events_path(), '--metrics-format', 'jsonl']
+    if len(_settings['profile']) > 0:
+        arguments += ['--profile', ','.join(_settings['profile']), '--profile-dir', _settings['profile_dir']]
+    if len(_settings['trace_memory']) > 0:
+        arguments += ['--trace-memory', ','.join(_settings['trace_memory'])]
+    return arguments
+
+def get_events_path():
+    if _settings['format'] == 'prometheus':
+        return _settings['path'] + EVENTS_SUFFIX
+    return _settings['path']
+
+def get_peak_rss_MB():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1) # bytes on macOS, kilobytes elsewhere
+
+def matches(name, names):
+    return any([name == prefix or name.startswith(prefix + '.') for prefix in names])
+
+class Stage():
+    def __init__(self, name, labels):
+        super().__init__()
+        self.name = name
+        self.labels = labels
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, rows=0, bytes=0):
+        self.rows += rows
+        self.bytes += bytes
+
+def start_tracing():
+    with _lock:
+        if _tracing_count[0] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing[0] = True
+        else:
+            tracemalloc.reset_peak()
+        _tracing_count[0] += 1
+
+def stop_tracing():
+    # the traced peak and a snapshot, taken before tracing can stop
+    with _lock:
+        try:
+            return tracemalloc.get_traced_memory()[1], tracemalloc.take_snapshot()
+        finally:
+            _tracing_count[0] -= 1
+            if _tracing_count[0] == 0 and _started_tracing[0]:
+                tracemalloc.stop()
+                _started_tracing[0] = False
+
+@contextmanager
+def stage(name, **labels):
+    current = Stage(name, labels)
+    recording = _settings['path'] is not None
+    profiling = matches(name, _settings['profile'])
+    tracing = matches(name, _settings['trace_memory'])
+    if not (recording or profiling or tracing):
+        yield current
+        return
+
+    if tracing:
+        start_tracing()
+    profiler = None
+    if profiling:
+        with _lock:
+            if not _profiler_active[0]:
+                _profiler_active[0] = True
+                profiler = cProfile.Profile()
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield current
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            with _lock:
+                _profiler_active[0] = False
+        # a failure to record the stage is only reported, so it never replaces the block's own result or exception
+        try:
+            record_stage(current, time.perf_counter() - start, tracing, profiler, recording)
+        except Exception as e:
+            print('[WARN] could not record stage {}: {}'.format(name, e))
+
+def record_stage(current, seconds, tracing, profiler, recording):
+    traced_peak, snapshot = stop_tracing() if tracing else (None, None) # first, so tracing always stops
+    event = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stage': current.name,
+        'labels': current.labels,
+        'seconds': round(seconds, 6),
+        'rows': current.rows,
+        'bytes': current.bytes,
+        'rows_per_second': round(current.rows / seconds, 1) if seconds > 0 else None,
+        'MB_per_second': round(current.bytes / seconds / 1e6, 3) if seconds > 0 else None,
+        'peak_rss_MB': get_peak_rss_MB(),
+        'pid': os.getpid(),
+    }
+    if tracing:
+        event['traced_peak_MB'] = round(traced_peak / 1024 ** 2, 1)
+        event['top_allocations'] = [str(statistic) for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+    if profiler is not None:
+        with _lock:
+            _profile_counter[0] += 1
+            count = _profile_counter[0]
+        os.makedirs(_settings['profile_dir'], exist_ok=True)
+        event['profile'] = os.path.join(_settings['profile_dir'], '{}-{}-{}.prof'.format(current.name, os.getpid(), count))
+        profiler.dump_stats(event['profile'])
+    if recording:
+        write_event(event)
+
+def write_event(event):
+    line = json.dumps(event) + '\n'
+    with _lock:
+        with open(get_events_path(), 'a') as events_file: # one small append per line, so processes don't interleave lines
+            events_file.write(line)
+
+def format_prometheus(events):
+    totals = {}
+    for event in events:
+        total = totals.setdefault(event['stage'], {'seconds': 0.0, 'runs': 0, 'rows': 0, 'bytes': 0, 'peak_rss_MB': 0.0})
+        total['seconds'] += event['seconds']
+        total['runs'] += 1
+        total['rows'] += event['rows']
+        total['bytes'] += event['bytes']
+        total['peak_rss_MB'] = max(total['peak_rss_MB'], event['peak_rss_MB'] or 0)
+    metrics = [
+        ('stage_seconds_total', 'counter', 'Wall time spent in the stage.', lambda total: total['seconds']),
+        ('stage_runs_total', 'counter', 'Number of times the stage ran.', lambda total: total['runs']),
+        ('stage_rows_total', 'counter', 'Rows the stage processed.', lambda total: total['rows']),
+        ('stage_bytes_total', 'counter', 'Bytes the stage processed.', lambda total: total['bytes']),
+        ('stage_peak_rss_bytes', 'gauge', 'Highest peak resident memory of a process running the stage.', lambda total: int(total['peak_rss_MB'] * 1024 ** 2)),
+    ]
+    lines = []
+    for metric, metric_type, description, get_value in metrics:
+        lines.append('# HELP {}_{} {}'.format(PROMETHEUS_PREFIX, metric, description))
+        lines.append('# TYPE {}_{} {}'.format(PROMETHEUS_PREFIX, metric, metric_type))
+        for name in sorted(totals.keys()):
+            lines.append('{}_{}{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, metric, name.replace('\\', '\\\\').replace('"', '\\"'), get_value(totals[name])))
+    return '\n'.join(lines) + '\n'
+
+def finish():
+    # writes the prometheus textfile from this run's events. Call once, from the main process, after every stage is done
+    if _settings['path'] is None or _settings['format'] != 'prometheus':
+        return
+    events = []
+    if os.path.isfile(get_events_path()):
+        with open(get_events_path()) as events_file:
+            events = [json.loads(line) for line in events_file if len(line.strip()) > 0]
+    temp_path = _settings['path'] + '.tmp'
+    with open(temp_path, 'w') as textfile:
+        textfile.write(format_prometheus(events))
+    os.replace(temp_path, _settings['path'])
@@ -0,0 +1,143 @@
+import os
+import sqlite3
+import time
+
+from s3_listing import ObjectRecord, list_bucket
+
+SNAPSHOT_FILENAME = '.bucket-listings.sqlite'
+DEFAULT_TTL_HOURS = 24
+INSERT_BATCH_SIZE = 1000
+KEY_UPPER_BOUND = '\U0010ffff' # sorts after any key, so prefix <= key < prefix + KEY_UPPER_BOUND finds every key under prefix
+
+# A snapshot is one complete listing of a bucket URL for a prefix and delimiter, with the time it was fetched. Objects
+# are stored by (listing, key), so keys under any prefix are a range scan of that index. A listing without a delimiter
+# also answers queries for longer prefixes, e.g. the whole bucket answers prefix='2019'. Listings that were interrupted
+# are never marked complete and so never used.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    delimiter TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS objects (
+    listing_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    etag TEXT NOT NULL,
+    last_modified TEXT NOT NULL,
+    PRIMARY KEY (listing_id, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS common_prefixes (
+    listing_id INTEGER NOT NULL,
+    prefix TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS common_prefixes_listing ON common_prefixes (listing_id);
+'''
+
+def normalize_url(url):
+    return url if url.endswith('/') else url + '/'
+
+class ListingSnapshots():
+    def __init__(self, path=SNAPSHOT_FILENAME):
+        super().__init__()
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def find(self, url, prefix=None, delimiter=None, max_age=None):
+        # the newest complete listing that covers the query, as (id, fetched_at), or None
+        prefix, delimiter = prefix or '', delimiter or ''
+        rows = self.connection.execute('SELECT id, prefix, delimiter, fetched_at FROM listings WHERE url = ? AND complete = 1 ORDER BY fetched_at DESC', (normalize_url(url),))
+        for listing_id, listing_prefix, listing_delimiter, fetched_at in rows:
+            if max_age is not None and time.time() - fetched_at > max_age:
+                continue
+            if listing_delimiter == delimiter == '' and prefix.startswith(listing_prefix):
+                return listing_id, fetched_at
+            if listing_delimiter == delimiter and listing_prefix == prefix:
+                return listing_id, fetched_at
+        return None
+
+    def iter_records(self, listing_id, prefix=None, modified_after=None, modified_before=None, common_prefixes=None):
+        query = 'SELECT key, size, etag, last_modified FROM objects WHERE listing_id = ?'
+        params = [listing_id]
+        if prefix:
+            query += ' AND key >= ? AND key < ?'
+            params += [prefix, prefix + KEY_UPPER_BOUND]
+        if modified_after:
+            query += ' AND last_modified >= ?'
+            params.append(modified_after)
+        if modified_before:
+            query += ' AND last_modified < ?'
+            params.append(modified_before)
+        if common_prefixes is not None:
+            common_prefixes += [row[0] for row in self.connection.execute('SELECT prefix FROM common_prefixes WHERE listing_id = ? ORDER BY prefix', (listing_id,))]
+        for row in self.connection.execute(query + ' ORDER BY key', params):
+            yield ObjectRecord(*row)
+
+    def record_listing(self, url, records, prefix=None, delimiter=None, common_prefixes=None):
+        # passes the records through while storing them. The snapshot replaces older ones for the same query once the
+        # listing has been read to the end
+        url, prefix, delimiter = normalize_url(url), prefix or '', delimiter or ''
+        with self.connection:
+            listing_id = self.connection.execute('INSERT INTO listings (url, prefix, delimiter, fetched_at) VALUES (?, ?, ?, ?)', (url, prefix, delimiter, time.time())).lastrowid
+        batch = []
+        for record in records:
+            batch.append((listing_id, record.key, record.size, record.etag, record.last_modified))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                self.insert_objects(batch)
+                batch = []
+            yield record
+        self.insert_objects(batch)
+        with self.connection:
+            if common_prefixes is not None:
+                self.connection.executemany('INSERT INTO common_prefixes VALUES (?, ?)', [(listing_id, common_prefix) for common_prefix in common_prefixes])
+            old_ids = [(row[0],) for row in self.connection.execute('SELECT id FROM listings WHERE url = ? AND prefix = ? AND delimiter = ? AND id != ?', (url, prefix, delimiter, listing_id))]
+            self.delete_listings(old_ids)
+            self.connection.execute('UPDATE listings SET complete = 1 WHERE id = ?', (listing_id,))
+
+    def insert_objects(self, batch):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', batch)
+
+    def delete_listings(self, listing_ids):
+        self.connection.executemany('DELETE FROM objects WHERE listing_id = ?', listing_ids)
+        self.connection.executemany('DELETE FROM common_prefixes WHERE listing_id = ?', listing_ids)
+        self.connection.executemany('DELETE FROM listings WHERE id = ?', listing_ids)
+
+    def delete_incomplete(self):
+        with self.connection:
+            self.delete_listings([(row[0],) for row in self.connection.execute('SELECT id FROM listings WHERE complete = 0')])
+
+def is_in_date_range(record, modified_after=None, modified_before=None):
+    # LastModified is ISO 8601 (2020-01-01T00:00:00.000Z), so dates like 2020-01 or 2020-01-31 compare as strings
+    return (not modified_after or record.last_modified >= modified_after) and (not modified_before or record.last_modified < modified_before)
+
+def list_bucket_with_snapshots(url, snapshots, prefix=None, delimiter=None, list_type=1, common_prefixes=None, max_age=None, refresh=False, offline=False, modified_after=None, modified_before=None):
+    # yields the bucket's records from a snapshot younger than max_age seconds (any age when offline) or else lists the
+    # bucket and keeps a snapshot of it. refresh always lists the bucket
+    found = None
+    if not refresh:
+        found = snapshots.find(url, prefix, delimiter, None if offline else max_age)
+    if found is not None:
+        listing_id, fetched_at = found
+        print("Using the bucket listing from {} ({} minutes old). Use --refresh to list the bucket again.".format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(fetched_at)), int((time.time() - fetched_at) / 60)))
+        yield from snapshots.iter_records(listing_id, prefix, modified_after, modified_before, common_prefixes)
+        return
+    if offline:
+        raise RuntimeError("No bucket listing of {} for prefix '{}' in {}. Run without --offline first.".format(url, prefix or '', os.path.abspath(snapshots.path)))
+
+    snapshots.delete_incomplete()
+    listed_prefixes = []
+    records = list_bucket(url, prefix=prefix, delimiter=delimiter, list_type=list_type, common_prefixes=listed_prefixes)
+    for record in snapshots.record_listing(url, records, prefix, delimiter, listed_prefixes):
+        if is_in_date_range(record, modified_after, modified_before):
+            yield record
+    if common_prefixes is not None:
+        common_prefixes += listed_prefixes
@@ -1,10 +1,15 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import os
 import pandas as pd
 import numpy as np
-from datetime import datetime
-from tqdm import tqdm
 
-from column_conversions import START_DATETIME, FINAL_COLUMNS
-from update_weather import WEATHER_COLUMNS, WEATHER_CODES
+from column_conversions import START_DATETIME, FINAL_COLUMNS, OUTPUT_DATETIME_FORMAT, apply_final_dtypes
+from update_weather import WEATHER_COLUMNS, WEATHER_CODES, DATE_FORMAT, apply_weather_dtypes
+from constants import FORMATS, PARTITION_DIR, COMPLETE_PARTITION_DIR
+from storage import find_input, get_path, read_frame, write_frame
+from partitions import get_partition_entry, get_partition_path, load_metadata, read_partition, remove_city, remove_partition, save_metadata
+import instrumentation
 
 WEATHER_COLUMNS = WEATHER_COLUMNS[1:] # omit 'DATE'
 TIME_SINCE_COLUMNS = ['time_since_{}'.format(weather_column) for weather_column in WEATHER_COLUMNS]
@@ -16,58 +21,146 @@ def references_weather_type(col_name):
 
 RESULTING_COLUMNS = FINAL_COLUMNS + WEATHER_COLUMNS + [col for col in TIME_SINCE_COLUMNS if not references_weather_type(col)] + [TIME_SINCE_WEATHER_TYPE]
 
-def add_nearest_weather(city, debug):
-    print('starting bss csv download')
-    bss = pd.read_csv('../final-bss-data/{}_bss.csv'.format(city))
-    print('finished downloading bss csv')
-    bss = bss.sort_values(START_DATETIME)
-    weather = pd.read_csv('{}-updated-weather.csv'.format(city))
-    weather = weather.sort_values('DATE')
-    weather_na = weather.isna()
-
-    weather_at_start = None
-    weather_indices = [[i for i, is_na in enumerate(weather_na[col_name]) if not is_na][0] for col_name in WEATHER_COLUMNS]
-    print('starting loop')
-    end = len(bss) if not debug else 100
-    for bss_index in tqdm(range(0, end)):
-        start_datetime = datetime.strptime(bss[START_DATETIME].iloc[bss_index], '%Y-%m-%d %H:%M:%S')
-
-        def get_diff(index):
-            weather_datetime = datetime.strptime(weather.DATE.iloc[index], '%Y-%m-%dT%H:%M:%S')
-            delta = weather_datetime - start_datetime
-            return (delta.days * 24 + delta.seconds / 3600) # hours
-
-        differences = []
-        for k in range(0, len(weather_indices)):
-            difference = get_diff(weather_indices[k]) # in minutes
-            while weather_indices[k] < len(weather) - 1:
-                new_index = weather_indices[k] + 1
-                while new_index < len(weather) - 1 and weather_na[WEATHER_COLUMNS[k]].iloc[new_index]:
-                    new_index += 1
-                new_difference = get_diff(new_index)
-                if abs(new_difference) > abs(difference):
-                    break
-                difference = new_difference
-                weather_indices[k] = new_index
-            differences.append(difference)
-        weather_values = {col_name: weather[col_name].iloc[i] for col_name, i in zip(WEATHER_COLUMNS, weather_indices)}
-        for col_name, diff in zip(TIME_SINCE_COLUMNS, differences):
-            if references_weather_type(col_name):
-                weather_values[TIME_SINCE_WEATHER_TYPE] = round(diff, 2)
-            else: 
-                weather_values[col_name] = round(diff, 2)
-        df_row = pd.DataFrame(weather_values, index=[bss_index])
-        if weather_at_start is None:
-            weather_at_start = df_row
+def round_hours(hours):
+    # matches Python's round(x, 2), which np.round doesn't always do in the last digit. Only unique values go through Python
+    uniques, inverse = np.unique(hours, return_inverse=True)
+    return np.array([round(value, 2) for value in uniques.tolist()])[inverse.reshape(-1)]
+
+def hours_between(start_times, end_times):
+    # same float steps as timedelta.days * 24 + timedelta.seconds / 3600, so ties and rounding come out as they always have
+    seconds = (end_times - start_times) // np.timedelta64(1, 's')
+    days = np.floor_divide(seconds, 24 * 3600)
+    return days * 24 + (seconds - days * 24 * 3600) / 3600
+
+def nearest_weather(weather_times, trip_times):
+    # For each trip, the position in weather_times (sorted, without the rows missing this column) of the report closest to
+    # the trip's start and the hours from the start to that report. Ties go to the later report, like the old per-row loop.
+    if len(weather_times) == 0:
+        return np.zeros(len(trip_times), dtype=int), np.full(len(trip_times), np.nan)
+    after = np.clip(np.searchsorted(weather_times, trip_times, side='left'), 0, len(weather_times) - 1)
+    before = np.clip(after - 1, 0, len(weather_times) - 1)
+    after_hours = hours_between(trip_times, weather_times[after])
+    before_hours = hours_between(trip_times, weather_times[before])
+    nearest = np.where(np.abs(after_hours) <= np.abs(before_hours), after, before)
+    nearest = np.searchsorted(weather_times, weather_times[nearest], side='right') - 1 # last of several reports with the same time
+    return nearest, round_hours(hours_between(trip_times, weather_times[nearest]))
+
+def join_weather(bss, weather, city, end=None):
+    # bss sorted by START_DATETIME and weather by DATE. Adds the nearest report of every weather column to the first end trips
+    with instrumentation.stage('merge_weather.join', city=city) as join_stage:
+        weather_na = weather.isna()
+        # typed formats already hold datetimes, csvs hold strings. Either way they're parsed once here
+        start_datetimes = pd.to_datetime(bss[START_DATETIME], format=OUTPUT_DATETIME_FORMAT)
+        weather_datetimes = pd.to_datetime(weather.DATE, format=DATE_FORMAT)
+
+        end = len(bss) if end is None else end
+        bss_for_concat = bss.iloc[0:end]
+        trip_times = start_datetimes.iloc[0:end].to_numpy()
+
+        weather_times = weather_datetimes.to_numpy()
+        weather_values = {}
+        for col_name, time_since_col_name in zip(WEATHER_COLUMNS, TIME_SINCE_COLUMNS):
+            reported = np.flatnonzero(~weather_na[col_name].to_numpy()) # rows that have a value for this column
+            nearest, hours = nearest_weather(weather_times[reported], trip_times)
+            if len(reported) > 0:
+                weather_values[col_name] = weather[col_name].to_numpy()[reported[nearest]]
+            else:
+                weather_values[col_name] = np.full(len(trip_times), np.nan)
+            # every weather type is derived from the same codes, so they share one time_since column (the last one wins, as before)
+            weather_values[TIME_SINCE_WEATHER_TYPE if references_weather_type(time_since_col_name) else time_since_col_name] = hours
+        weather_at_start = pd.DataFrame(weather_values, index=bss_for_concat.index)
+        result = pd.concat([bss_for_concat, weather_at_start], axis=1, sort=False)
+        result = result[RESULTING_COLUMNS]
+        join_stage.add(rows=len(result))
+    return result
+
+def get_weather_window(weather, weather_times, start, end):
+    # The weather rows from the last report before start to the first report after end, taken over every column. The
+    # nearest report to any trip in [start, end] is always among them, so joining against the window gives the same
+    # result as joining against the whole file
+    window_start, window_end = None, None
+    for col_name in WEATHER_COLUMNS:
+        reported_times = weather_times[weather[col_name].notna().to_numpy()]
+        if len(reported_times) == 0:
+            continue
+        before = reported_times[max(np.searchsorted(reported_times, start, side='left') - 1, 0)]
+        after = reported_times[min(np.searchsorted(reported_times, end, side='right'), len(reported_times) - 1)]
+        window_start = before if window_start is None else min(window_start, before)
+        window_end = after if window_end is None else max(window_end, after)
+    if window_start is None:
+        return weather
+    return weather[(weather_times >= window_start) & (weather_times <= window_end)]
+
+def add_nearest_weather(city, debug, output_format='csv', bss_dir='../final-bss-data'):
+    with instrumentation.stage('merge_weather', city=city) as merge_weather_stage:
+        with instrumentation.stage('merge_weather.read', city=city) as read_stage:
+            print('starting bss download')
+            bss = read_frame(find_input(os.path.join(bss_dir, '{}_bss'.format(city)), output_format))
+            print('finished downloading bss')
+            bss = bss.sort_values(START_DATETIME)
+            weather = read_frame(find_input('{}-updated-weather'.format(city), output_format))
+            weather = weather.sort_values('DATE')
+            read_stage.add(rows=len(bss) + len(weather))
+
+        result = join_weather(bss, weather, city, None if not debug else 100)
+        merge_weather_stage.add(rows=len(result))
+        if debug:
+            return result
         else:
-            weather_at_start = weather_at_start.append(df_row)
-    bss_for_concat = bss if not debug else bss.iloc[0:100]
-    result = pd.concat([bss_for_concat, weather_at_start], axis=1, sort=False)
-    result = result[RESULTING_COLUMNS]
-    if debug:
-        return result
-    else:
-        result.to_csv('complete_{}_bss.csv'.format(city))
+            with instrumentation.stage('merge_weather.write', city=city, format=output_format):
+                write_frame(result, get_path('complete_{}_bss'.format(city), output_format), lambda df: apply_weather_dtypes(apply_final_dtypes(df)))
+
+def join_partition(city, label, input_root, entry, weather, weather_times, output_root, output_format):
+    # joins one month of trips with the weather around it and writes it as the same partition of output_root
+    with instrumentation.stage('merge_weather.partition', city=city, partition=label) as partition_stage:
+        bss = read_partition(input_root, entry).sort_values(START_DATETIME)
+        window = get_weather_window(weather, weather_times, np.datetime64(pd.Timestamp(entry['min_start_datetime'])), np.datetime64(pd.Timestamp(entry['max_start_datetime'])))
+        result = join_weather(bss, window, city)
+        path = get_partition_path(output_root, city, label, output_format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(path), 'part.tmp' + FORMATS[output_format])
+        with instrumentation.stage('merge_weather.write', city=city, format=output_format):
+            write_frame(result, temp_path, lambda df: apply_weather_dtypes(apply_final_dtypes(df)))
+        os.replace(temp_path, path)
+        partition_stage.add(rows=len(result))
+    return label, get_partition_entry(output_root, path, len(result), pd.Timestamp(entry['min_start_datetime']), pd.Timestamp(entry['max_start_datetime']), entry['sources'])
+
+def is_partition_up_to_date(output_root, output_entry, input_root, input_entry, weather_path):
+    if output_entry is None or not os.path.isfile(os.path.join(output_root, output_entry['path'])):
+        return False
+    output_mtime = os.path.getmtime(os.path.join(output_root, output_entry['path']))
+    return output_mtime >= os.path.getmtime(os.path.join(input_root, input_entry['path'])) and output_mtime >= os.path.getmtime(weather_path)
+
+def add_nearest_weather_partitioned(city, input_root=PARTITION_DIR, output_root=COMPLETE_PARTITION_DIR, output_format='csv', jobs=1):
+    # Joins the weather one partition (month) at a time, so only one month of trips is in memory per process, and only
+    # joins the partitions whose trips or weather changed since they were last joined
+    weather_path = find_input('{}-updated-weather'.format(city), output_format)
+    with instrumentation.stage('merge_weather.read', city=city) as read_stage:
+        weather = read_frame(weather_path).sort_values('DATE')
+        weather_times = pd.to_datetime(weather.DATE, format=DATE_FORMAT).to_numpy()
+        read_stage.add(rows=len(weather))
+    input_metadata = load_metadata(input_root, city)
+    metadata = load_metadata(output_root, city)
+    if metadata.get('format') != output_format:
+        remove_city(output_root, city)
+        metadata = {'city': city, 'format': output_format, 'partitions': {}}
+    for label in [label for label in metadata['partitions'].keys() if label not in input_metadata['partitions']]:
+        remove_partition(output_root, metadata, label) # its trips are gone
+    partitions = [(label, entry) for label, entry in sorted(input_metadata['partitions'].items())
+        if not is_partition_up_to_date(output_root, metadata['partitions'].get(label), input_root, entry, weather_path)]
+    print('[INFO] joining {} of {} partitions of {}'.format(len(partitions), len(input_metadata['partitions']), city))
+
+    with instrumentation.stage('merge_weather', city=city, partitioned=True) as merge_weather_stage:
+        if jobs <= 1:
+            joined = [join_partition(city, label, input_root, entry, weather, weather_times, output_root, output_format) for label, entry in partitions]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(join_partition, city, label, input_root, entry, weather, weather_times, output_root, output_format) for label, entry in partitions]
+                joined = [future.result() for future in futures]
+        for label, entry in joined:
+            metadata['partitions'][label] = entry
+            merge_weather_stage.add(rows=entry['rows'])
+    save_metadata(output_root, city, metadata)
 
 # add_nearest_weather('columbus', False)
 # add_nearest_weather('portland', False)
@@ -87,3 +180,21 @@ def add_nearest_weather(city, debug):
 # len(weather.DATE[weather.snow.notna()].unique()) == sum(weather.snow.notna())
 # delta = last_weather_date - columbus_date
 # return (delta.days * 24 + delta.seconds / 3600) # hours
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("cities", nargs="+", help="Cities to add weather to. Reads {city}_bss from --bss-dir and {city}-updated-weather from the current directory.")
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), required=False, default="csv", help="Output format of complete_{city}_bss. Its inputs are read in this format too when they exist in it, otherwise in the format written last. Default is csv.")
+    parser.add_argument("--bss-dir", required=False, default="../final-bss-data", help="Directory holding the merged {city}_bss files. Default is ../final-bss-data.")
+    parser.add_argument("--partitioned", required=False, action="store_true", default=False, help="Joins the partitioned output of merger.py --partitioned ({} inside --bss-dir) one month at a time and writes it partitioned the same way to --output-dir.".format(PARTITION_DIR))
+    parser.add_argument("--output-dir", required=False, default=COMPLETE_PARTITION_DIR, help="Root of the partitioned output. Default is {}.".format(COMPLETE_PARTITION_DIR))
+    parser.add_argument("--jobs", "-j", type=int, required=False, default=1, help="With --partitioned, number of partitions joined at the same time, each in its own process. Default is 1.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    for city in args.cities:
+        if args.partitioned:
+            add_nearest_weather_partitioned(city, os.path.join(args.bss_dir, PARTITION_DIR), args.output_dir, args.format, args.jobs)
+        else:
+            add_nearest_weather(city, False, args.format, args.bss_dir)
+    instrumentation.finish()
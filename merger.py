@@ -1,7 +1,18 @@
-import pandas as pd
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import os
+import pickle
+import tempfile
 from tqdm import tqdm
-from column_conversions import FINAL_COLUMNS, CITIES, convert_df 
+from column_conversions import FINAL_COLUMNS, CITIES, CONVERTERS, convert_chunks, convert_df, use_distance_cache
+from conversion_cache import CACHE_DIR, DEFAULT_MAX_BYTES, ConversionCache, converter_fingerprint
+from distances import DISTANCE_METHODS
+from ingest import read_trips
+from partitions import PartitionedWriter, load_metadata, remove_city, remove_partition, save_metadata, split_by_month
+from constants import CSV_ENGINES, FORMATS, PARTITION_DIR
+from storage import FrameWriter, get_path
+import instrumentation
 
 # boston_weather = pd.read_csv('./weather/boston-weather.csv')
 # dc_weather = pd.read_csv('./weather/dc-weather-washington-reagan-airport-arlington-va.csv')
@@ -10,32 +21,213 @@ from column_conversions import FINAL_COLUMNS, CITIES, convert_df
 # columbus_weather = pd.read_csv('./weather/columbus-weather-john-glen-airport.csv')
 # portland_weather = pd.read_csv('./weather/portland-weather-troutdale-airport.csv')
 
-all_bss = None
-for city in CITIES:
-    folder = './bss/{}/'.format(city)
-    print('Starting to merge files for {}'.format(city))
-    city_bss = None
-    with os.scandir(folder) as files:
-        for file in tqdm(sorted(files, key=lambda file: file.name)):
-            if file.name.endswith('.csv') and file.is_file():
-                df = pd.read_csv(file.path)
-                print('Processing {}'.format(file.name))
-                converted_df = convert_df(df, city)
+def read_converted(path, city, chunksize=None, distance_method='geodesic', compact=False, engine='c'):
+    if chunksize:
+        yield from convert_chunks(read_trips(path, city, chunksize, engine), city, distance_method, compact)
+    else:
+        yield convert_df(read_trips(path, city, engine=engine), city, distance_method, compact)
+
+def convert_file(path, city, chunksize, distance_method, compact=False, engine='c'):
+    return list(read_converted(path, city, chunksize, distance_method, compact, engine))
+
+def list_city_files(city):
+    with os.scandir('./bss/{}/'.format(city)) as files:
+        return [file.path for file in sorted(files, key=lambda file: file.name) if file.name.endswith('.csv') and file.is_file()]
+
+def read_converted_cached(cache, path, city, chunksize=None, distance_method='geodesic', compact=False, engine='c'):
+    if cache is None:
+        return read_converted(path, city, chunksize, distance_method, compact, engine)
+    key = cache.get_key(path, city, distance_method, compact, engine)
+    cached = cache.load(city, key)
+    if cached is not None:
+        return cached
+    return cache.store(city, key, read_converted(path, city, chunksize, distance_method, compact, engine))
+
+def iter_converted_files(tasks, jobs, chunksize, distance_method, compact=False, cache=None, distance_cache_dir=None, engine='c'):
+    # yields (city, path, converted frames) in the same order as tasks, whatever order the workers finish in
+    if jobs <= 1:
+        for city, path in tasks:
+            yield city, path, read_converted_cached(cache, path, city, chunksize, distance_method, compact, engine)
+        return
+    initializer, initargs = (use_distance_cache, (distance_cache_dir,)) if distance_cache_dir else (None, ())
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        def next_converted():
+            city, path, key, cached, future = pending.popleft()
+            if future is None:
+                return city, path, cached
+            if cache is None:
+                return city, path, future.result()
+            return city, path, cache.store(city, key, future.result())
+
+        for city, path in tasks:
+            key = cache.get_key(path, city, distance_method, compact, engine) if cache is not None else None
+            cached = cache.load(city, key) if cache is not None else None
+            future = executor.submit(convert_file, path, city, chunksize, distance_method, compact, engine) if cached is None else None
+            pending.append((city, path, key, cached, future))
+            if len(pending) > 2 * jobs: # bounds how many converted files wait in memory for their turn
+                yield next_converted()
+        while len(pending) > 0:
+            yield next_converted()
+
+def merge(jobs=1, chunksize=None, distance_method='geodesic', write_all=False, output_format='csv', cache=None, distance_cache_dir=None, cities=None, engine='c'):
+    cities = list(CITIES) if cities is None else cities
+    for city in cities:
+        if city not in CITIES:
+            raise ValueError('{} is not a valid city'.format(city))
+    if distance_cache_dir:
+        use_distance_cache(distance_cache_dir)
+    tasks = [(city, path) for city in cities for path in list_city_files(city)]
+    compact = output_format != 'csv' # typed outputs are converted straight to FINAL_DTYPES, which also keeps what workers send back small
+    all_bss = FrameWriter(get_path('all_bss', output_format)) if write_all else None
+    city_outputs = {}
+    with instrumentation.stage('merge', format=output_format) as merge_stage:
+        for city, path, converted_dfs in tqdm(iter_converted_files(tasks, jobs, chunksize, distance_method, compact, cache, distance_cache_dir, engine), total=len(tasks)):
+            if city not in city_outputs:
+                print('Starting to merge files for {}'.format(city))
+                city_outputs[city] = FrameWriter(get_path('{}_bss'.format(city), output_format))
+            print('Processing {}'.format(os.path.basename(path)))
+            for converted_df in converted_dfs:
                 # add_weather(converted_df, city)
-                if city_bss is None:
-                    city_bss = converted_df
-                else:
-                    city_bss = city_bss.append(converted_df)
-    city_bss = city_bss[FINAL_COLUMNS]
-    city_bss.to_csv('{}_bss.csv'.format(city))
-# FIXME uncomment rest if you have enough space on disk to merge all csvs at once
-#     if all_bss is None:
-#         all_bss = city_bss
-#     else:
-#         all_bss.append(city_bss)
-
-# all_bss = all_bss[FINAL_COLUMNS]
-# all_bss.to_csv('all_bss.csv')
+                with instrumentation.stage('merge.write', city=city) as write_stage:
+                    city_outputs[city].write(converted_df[FINAL_COLUMNS])
+                    if all_bss is not None:
+                        all_bss.write(converted_df[FINAL_COLUMNS])
+                    write_stage.add(rows=len(converted_df))
+                merge_stage.add(rows=len(converted_df))
+        for output in list(city_outputs.values()) + [all_bss]:
+            if output is not None:
+                output.close()
+    if cache is not None:
+        cache.save()
+        print('[INFO] reused {} of {} converted files from {}'.format(cache.hits, cache.hits + cache.misses, cache.directory))
+    for city in cities:
+        if city not in city_outputs or city_outputs[city].row_count == 0:
+            print('[WARN] no trips were converted for {}'.format(city))
+
+def get_source_stat(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+# A partitioned merge only rewrites the partitions that new, changed or removed monthly files touch, along with the other
+# files that have rows in those partitions. Which partitions a changed file touches is only known once it's converted,
+# so changed files are converted first and spooled to a pickle stream on disk until their turn, which keeps memory at
+# one converted file (or chunk) however many files changed. Everything is rebuilt when the conversion itself changed
+# (see converter_fingerprint) or the format did.
+def spool_frames(frames, spool_path):
+    # writes frames to spool_path and passes them through
+    with open(spool_path, 'wb') as spool_file:
+        for frame in frames:
+            pickle.dump(frame, spool_file, protocol=pickle.HIGHEST_PROTOCOL)
+            yield frame
+
+def read_spooled(spool_path):
+    with open(spool_path, 'rb') as spool_file:
+        while True:
+            try:
+                yield pickle.load(spool_file)
+            except EOFError:
+                break
+    os.remove(spool_path)
+
+def merge_city_partitions(city, root, jobs=1, chunksize=None, distance_method='geodesic', output_format='csv', cache=None, distance_cache_dir=None, engine='c'):
+    compact = output_format != 'csv'
+    fingerprint = converter_fingerprint(CONVERTERS[city], distance_method, compact, engine)
+    metadata = load_metadata(root, city)
+    if metadata.get('fingerprint') != fingerprint or metadata.get('format') != output_format:
+        if len(metadata['partitions']) > 0:
+            print('[INFO] the conversion or format changed since {} was last merged, so all of its partitions are rebuilt'.format(city))
+        remove_city(root, city)
+        metadata = {'city': city, 'fingerprint': fingerprint, 'format': output_format, 'partitions': {}}
+
+    paths = list_city_files(city)
+    source_stats = {os.path.basename(path): get_source_stat(path) for path in paths}
+    recorded = {} # source -> labels of the partitions it has rows in
+    for label, entry in metadata['partitions'].items():
+        for source, stat in entry['sources'].items():
+            recorded.setdefault(source, set()).add(label)
+    def is_unchanged(source):
+        return source in recorded and all([metadata['partitions'][label]['sources'][source] == source_stats[source] for label in recorded[source]])
+    changed = [path for path in paths if not is_unchanged(os.path.basename(path))]
+    removed = [source for source in recorded.keys() if source not in source_stats]
+    if len(changed) == 0 and len(removed) == 0:
+        print('[INFO] every partition of {} is up to date'.format(city))
+        save_metadata(root, city, metadata)
+        return
+
+    labels = set()
+    for source in [os.path.basename(path) for path in changed] + removed:
+        labels |= recorded.get(source, set())
+    os.makedirs(root, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='.spool-', dir=root) as spool_dir:
+        spooled = {} # path of a changed file -> its converted frames on disk
+        if len(metadata['partitions']) > 0:
+            for _, path, converted_dfs in iter_converted_files([(city, path) for path in changed], jobs, chunksize, distance_method, compact, cache, distance_cache_dir, engine):
+                spooled[path] = os.path.join(spool_dir, '{}.pkl'.format(len(spooled)))
+                for converted_df in spool_frames((converted_df[FINAL_COLUMNS] for converted_df in converted_dfs), spooled[path]):
+                    labels |= set([label for label, _, _ in split_by_month(converted_df)])
+            to_read = [path for path in paths if path in spooled or len(recorded.get(os.path.basename(path), set()) & labels) > 0]
+        else:
+            labels = None # a new dataset, so every partition is written
+            to_read = paths
+
+        writer = PartitionedWriter(root, city, output_format)
+        tasks = [(city, path) for path in to_read if path not in spooled]
+        remaining = iter_converted_files(tasks, jobs, chunksize, distance_method, compact, cache, distance_cache_dir, engine)
+        with instrumentation.stage('merge', city=city, format=output_format, partitioned=True) as merge_stage:
+            for path in tqdm(to_read):
+                converted_dfs = read_spooled(spooled[path]) if path in spooled else next(remaining)[2]
+                for converted_df in converted_dfs:
+                    with instrumentation.stage('merge.write', city=city) as write_stage:
+                        writer.write(converted_df[FINAL_COLUMNS], os.path.basename(path), labels)
+                        write_stage.add(rows=len(converted_df))
+                    merge_stage.add(rows=len(converted_df))
+            written = writer.close(metadata, source_stats)
+    for label in (labels or set()) - written:
+        remove_partition(root, metadata, label) # only had rows of removed files
+    save_metadata(root, city, metadata)
+    print('[INFO] wrote {} partitions of {} ({} files read)'.format(len(written), city, len(to_read)))
+
+def merge_partitioned(root=PARTITION_DIR, jobs=1, chunksize=None, distance_method='geodesic', output_format='csv', cache=None, distance_cache_dir=None, cities=None, engine='c'):
+    cities = list(CITIES) if cities is None else cities
+    for city in cities:
+        if city not in CITIES:
+            raise ValueError('{} is not a valid city'.format(city))
+    if distance_cache_dir:
+        use_distance_cache(distance_cache_dir)
+    for city in cities:
+        merge_city_partitions(city, root, jobs, chunksize, distance_method, output_format, cache, distance_cache_dir, engine)
+    if cache is not None:
+        cache.save()
+        print('[INFO] reused {} of {} converted files from {}'.format(cache.hits, cache.hits + cache.misses, cache.directory))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--distance", choices=sorted(DISTANCE_METHODS.keys()), required=False, default="geodesic", help="How trip distances are computed. 'geodesic' (default) is exact but slow, 'vincenty' is vectorized and within 0.5 mm of it, 'haversine' is fastest but off by up to about 0.6%%.")
+    parser.add_argument("--chunksize", type=int, required=False, help="Reads and converts each monthly csv this many rows at a time instead of all at once. Keeps memory bounded for very large months.")
+    parser.add_argument("--all", required=False, action="store_true", default=False, help="Also writes every city's trips into all_bss.csv.")
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), required=False, default="csv", help="Output format. parquet and feather store typed columns (categories, small ints, datetimes) and need pyarrow. Default is csv.")
+    parser.add_argument("--jobs", "-j", type=int, required=False, default=1, help="Number of monthly files converted at the same time, each in its own process. Output is still written in filename order. Default is 1.")
+    parser.add_argument("--no-cache", required=False, action="store_true", default=False, help="Converts every file again instead of reusing earlier conversions of unchanged files.")
+    parser.add_argument("--cache-dir", required=False, default=CACHE_DIR, help="Where converted files are cached. Default is {}.".format(CACHE_DIR))
+    parser.add_argument("--cache-max-MB", type=int, required=False, default=DEFAULT_MAX_BYTES // 1024 ** 2, help="Least recently used conversions are dropped once the cache is bigger than this. Default is %(default)s.")
+    parser.add_argument("--distance-cache-dir", required=False, help="Keeps the distance of every station pair in this directory (one file per city and distance method) so later months and runs don't compute them again.")
+    parser.add_argument("--partitioned", required=False, action="store_true", default=False, help="Writes one file per city and month trips started in, under --partition-dir, instead of {city}_bss. Only the months new or changed monthly files touch are written again.")
+    parser.add_argument("--partition-dir", required=False, default=PARTITION_DIR, help="Root of the partitioned output. Default is {}.".format(PARTITION_DIR))
+    parser.add_argument("--csv-engine", choices=CSV_ENGINES, required=False, default="c", help="Parser for the monthly csvs. pyarrow reads each file with several threads (with --jobs, consider fewer jobs) and needs pyarrow installed. It can't be used with --chunksize. Default is c.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    if args.chunksize and args.csv_engine == 'pyarrow':
+        parser.error("--chunksize can't be used with --csv-engine pyarrow")
+    if args.partitioned and args.all:
+        parser.error("--all can't be used with --partitioned, the partitions already hold every city")
+    cache = ConversionCache(args.cache_dir, args.cache_max_MB * 1024 ** 2) if not args.no_cache else None
+    if args.partitioned:
+        merge_partitioned(args.partition_dir, args.jobs, args.chunksize, args.distance, args.format, cache, args.distance_cache_dir, engine=args.csv_engine)
+    else:
+        merge(args.jobs, args.chunksize, args.distance, args.all, args.format, cache, args.distance_cache_dir, engine=args.csv_engine)
+    instrumentation.finish()
 
 
 ## Useful for EDA when station names and coordinates were included. Checking coordinates for stations
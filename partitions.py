@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from column_conversions import START_DATETIME, OUTPUT_DATETIME_FORMAT
+from constants import FORMATS, METADATA_FILENAME
+from storage import FrameWriter, read_frame
+
+PART_STEM = 'part'
+
+# A partitioned dataset keeps each city's trips as one file per month they started in:
+#   {root}/city=nyc/year=2019/month=01/part.csv
+# next to {root}/city=nyc/_metadata.json, which has an entry per partition with its path, row count, first and last
+# start_datetime and the source files its rows came from (with their size and mtime, so the merger can tell which
+# partitions a new or changed monthly file touches). Readers go through the metadata only, so partitions outside the
+# cities or dates asked for are never opened.
+def get_city_dir(root, city):
+    return os.path.join(root, 'city={}'.format(city))
+
+def get_partition_label(year, month):
+    return '{:04d}-{:02d}'.format(year, month)
+
+def get_partition_path(root, city, label, file_format):
+    year, month = label.split('-')
+    return os.path.join(get_city_dir(root, city), 'year={}'.format(year), 'month={}'.format(month), PART_STEM + FORMATS[file_format])
+
+def get_start_datetimes(df):
+    if pd.api.types.is_datetime64_any_dtype(df[START_DATETIME]):
+        return df[START_DATETIME]
+    return pd.to_datetime(df[START_DATETIME], format=OUTPUT_DATETIME_FORMAT)
+
+def split_by_month(df):
+    # yields (label, rows, their start datetimes) for every month the trips in df started in
+    start_datetimes = get_start_datetimes(df)
+    have_start = start_datetimes.notna().to_numpy()
+    if not have_start.all():
+        print('[WARN] leaving out {} trips without a start time'.format(int((~have_start).sum())))
+    keys = np.where(have_start, start_datetimes.dt.year.fillna(0).to_numpy() * 100 + start_datetimes.dt.month.fillna(0).to_numpy(), -1).astype(int)
+    for key, positions in sorted(pd.Series(keys).groupby(keys).indices.items()):
+        if key >= 0:
+            yield get_partition_label(key // 100, key % 100), df.take(positions), start_datetimes.take(positions)
+
+def load_metadata(root, city):
+    path = os.path.join(get_city_dir(root, city), METADATA_FILENAME)
+    if not os.path.isfile(path):
+        return {'city': city, 'partitions': {}}
+    with open(path) as metadata_file:
+        return json.load(metadata_file)
+
+def save_metadata(root, city, metadata):
+    path = os.path.join(get_city_dir(root, city), METADATA_FILENAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+def remove_partition(root, metadata, label):
+    partition = metadata['partitions'].pop(label)
+    path = os.path.join(root, partition['path'])
+    if os.path.isfile(path):
+        os.remove(path)
+
+def remove_city(root, city):
+    if os.path.isdir(get_city_dir(root, city)):
+        shutil.rmtree(get_city_dir(root, city))
+
+def get_partition_entry(root, path, rows, min_start, max_start, sources):
+    return {
+        'path': os.path.relpath(path, root),
+        'rows': rows,
+        'min_start_datetime': min_start.strftime(OUTPUT_DATETIME_FORMAT),
+        'max_start_datetime': max_start.strftime(OUTPUT_DATETIME_FORMAT),
+        'sources': sources,
+    }
+
+class PartitionedWriter():
+    # writes rows into their month's partition as they come in. Each partition is written to a temporary file that only
+    # replaces the old one in close(), so readers never see a partition half written
+    def __init__(self, root, city, output_format):
+        super().__init__()
+        self.root = root
+        self.city = city
+        self.output_format = output_format
+        self.partitions = {}
+
+    def write(self, df, source, labels=None):
+        # labels limits the partitions written to, for sources whose other partitions are already up to date
+        for label, rows, start_datetimes in split_by_month(df):
+            if labels is not None and label not in labels:
+                continue
+            if label not in self.partitions:
+                path = get_partition_path(self.root, self.city, label, self.output_format)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = os.path.join(os.path.dirname(path), '{}.tmp{}'.format(PART_STEM, FORMATS[self.output_format]))
+                self.partitions[label] = {'path': path, 'writer': FrameWriter(temp_path), 'min': None, 'max': None, 'sources': set()}
+            partition = self.partitions[label]
+            partition['writer'].write(rows)
+            partition['min'] = start_datetimes.min() if partition['min'] is None else min(partition['min'], start_datetimes.min())
+            partition['max'] = start_datetimes.max() if partition['max'] is None else max(partition['max'], start_datetimes.max())
+            partition['sources'].add(source)
+
+    def close(self, metadata, source_stats):
+        # replaces the written partitions and records them in metadata
+        for label, partition in sorted(self.partitions.items()):
+            writer = partition['writer']
+            writer.close()
+            os.replace(writer.path, partition['path'])
+            sources = {source: source_stats[source] for source in sorted(partition['sources'])}
+            metadata['partitions'][label] = get_partition_entry(self.root, partition['path'], writer.row_count, partition['min'], partition['max'], sources)
+        return set(self.partitions.keys())
+
+def list_partitions(root, cities=None, start=None, end=None):
+    # yields (city, label, entry) for the partitions that can hold trips starting in [start, end). start and end are
+    # dates or times like 2019-01, 2019-01-31 or 2019-01-31 12:00, compared with the metadata as strings
+    if not os.path.isdir(root):
+        return
+    for name in sorted(os.listdir(root)):
+        if not name.startswith('city=') or (cities is not None and name[len('city='):] not in cities):
+            continue
+        city = name[len('city='):]
+        metadata = load_metadata(root, city)
+        for label, entry in sorted(metadata['partitions'].items()):
+            if start and entry['max_start_datetime'] < start:
+                continue
+            if end and entry['min_start_datetime'] >= end:
+                continue
+            yield city, label, entry
+
+def read_partition(root, entry, columns=None, start=None, end=None):
+    filtering = start or end
+    read_columns = columns + [START_DATETIME] if filtering and columns is not None and START_DATETIME not in columns else columns
+    df = read_frame(os.path.join(root, entry['path']), read_columns)
+    if filtering:
+        start_datetimes = get_start_datetimes(df)
+        keep = np.ones(len(df), dtype=bool)
+        if start:
+            keep &= (start_datetimes >= pd.Timestamp(start)).to_numpy()
+        if end:
+            keep &= (start_datetimes < pd.Timestamp(end)).to_numpy()
+        df = df[keep]
+    return df[columns] if columns is not None else df
+
+def iter_partitions(root, cities=None, start=None, end=None, columns=None):
+    # yields (city, label, trips) one partition at a time, only reading the partitions that can match
+    for city, label, entry in list_partitions(root, cities, start, end):
+        yield city, label, read_partition(root, entry, columns, start, end)
+
+def read_partitions(root, cities=None, start=None, end=None, columns=None):
+    frames = [df for _, _, df in iter_partitions(root, cities, start, end, columns)]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames)
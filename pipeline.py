@@ -0,0 +1,275 @@
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+
+from constants import FORMATS, DISTANCE_METHOD_NAMES, CSV_ENGINES, PARTITION_DIR, COMPLETE_PARTITION_DIR, METADATA_FILENAME
+import instrumentation
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STEPS = ['download', 'unzip', 'merge', 'update_weather', 'merge_weather']
+# Where each city's data comes from. 'url' is the bucket file-downloader.py lists (without one, bss/{city} is filled by
+# hand and never downloaded), 'filename_pattern' picks the city's files in it and 'weather' is the station's LCD file.
+# --config takes a JSON file with the same layout, whose entries are merged into these.
+SOURCES = {
+    'boston': {'weather': './weather/boston-weather.csv'},
+    'portland': {'weather': './weather/portland-weather-troutdale-airport.csv'},
+    'columbus': {'weather': './weather/columbus-weather-john-glen-airport.csv'},
+    'nyc': {'weather': './weather/nyc-weather-laguardia-airport.csv'},
+}
+# a step reruns when the code it runs changed, too
+CODE = {
+    'merge': ['merger.py', 'column_conversions.py', 'constants.py', 'distances.py', 'ingest.py', 'partitions.py', 'storage.py'],
+    'update_weather': ['update_weather.py', 'constants.py', 'storage.py'],
+    'merge_weather': ['merge-weather.py', 'update_weather.py', 'column_conversions.py', 'constants.py', 'partitions.py', 'storage.py'],
+}
+
+# Runs download -> unzip -> merge -> update_weather -> merge_weather for every city, from the data directory (--dir).
+# Each step of each city is a task that only depends on the earlier steps of its own city, so cities run side by side
+# with --jobs. Like make, a task only runs when one of its outputs is missing or older than one of its inputs (the
+# files it reads and the code it runs), or when a task it depends on runs. Downloads only run when asked for with
+# --download or when the city has no files yet, since a bucket's contents can't be checked without listing it.
+# Nothing heavier than the standard library is imported here: pandas and the other scripts are only loaded by the
+# tasks that run, so --help and --dry-run start right away.
+class Task():
+    def __init__(self, step, city, deps, inputs=None, outputs=None, check=None):
+        super().__init__()
+        self.step = step
+        self.city = city
+        self.name = '{}:{}'.format(step, city)
+        self.deps = deps
+        self.inputs = inputs or (lambda: [])
+        self.outputs = outputs or []
+        self.check = check # used instead of comparing inputs and outputs
+
+    def get_reason(self):
+        # why the task has to run, or None if it's up to date
+        if self.check is not None:
+            return self.check()
+        for output in self.outputs:
+            if not os.path.exists(output):
+                return '{} is missing'.format(output)
+        oldest_output = min([os.path.getmtime(output) for output in self.outputs])
+        for path in self.inputs():
+            if not os.path.exists(path):
+                return '{} is missing'.format(path)
+            if os.path.getmtime(path) > oldest_output:
+                return '{} changed'.format(path)
+        return None
+
+def get_city_dir(city):
+    return os.path.join('bss', city)
+
+def list_files(city, extension):
+    return sorted(glob.glob(os.path.join(get_city_dir(city), '*' + extension)))
+
+def get_code_paths(step):
+    return [os.path.join(REPO_DIR, filename) for filename in CODE[step]]
+
+def get_tasks(cities, sources, args):
+    tasks = []
+    for city in cities:
+        source = sources[city]
+        bss_output = '{}_bss.{}'.format(city, args.format)
+        weather_output = '{}-updated-weather.{}'.format(city, args.format)
+        complete_output = 'complete_{}_bss.{}'.format(city, args.format)
+        if args.partitioned: # the partitioned steps rewrite the city's metadata every time they run
+            bss_output = os.path.join(PARTITION_DIR, 'city={}'.format(city), METADATA_FILENAME)
+            complete_output = os.path.join(COMPLETE_PARTITION_DIR, 'city={}'.format(city), METADATA_FILENAME)
+
+        def check_download(city=city, source=source):
+            if not source.get('url'):
+                return None
+            if args.download:
+                return 'asked for with --download'
+            if len(list_files(city, '.csv') + list_files(city, '.zip')) == 0:
+                return 'nothing downloaded yet'
+            return None
+
+        def check_unzip(city=city):
+            archives = list_files(city, '.zip')
+            return '{} archives to extract'.format(len(archives)) if len(archives) > 0 else None
+
+        tasks.append(Task('download', city, [], check=check_download))
+        tasks.append(Task('unzip', city, ['download:' + city], check=check_unzip))
+        tasks.append(Task('merge', city, ['unzip:' + city], lambda city=city: list_files(city, '.csv') + get_code_paths('merge'), [bss_output]))
+        if not source.get('weather'):
+            print('[WARN] no weather file for {}, skipping its weather steps'.format(city))
+            continue
+        tasks.append(Task('update_weather', city, [], lambda source=source: [source['weather']] + get_code_paths('update_weather'), [weather_output]))
+        tasks.append(Task('merge_weather', city, ['merge:' + city, 'update_weather:' + city],
+            lambda bss_output=bss_output, weather_output=weather_output: [bss_output, weather_output] + get_code_paths('merge_weather'),
+            [complete_output]))
+    return tasks
+
+def select_tasks(tasks, steps):
+    # the tasks of the given steps and every task they depend on
+    by_name = {task.name: task for task in tasks}
+    selected = set()
+    pending = [task.name for task in tasks if task.step in steps]
+    while len(pending) > 0:
+        name = pending.pop()
+        if name in selected or name not in by_name:
+            continue
+        selected.add(name)
+        pending += by_name[name].deps
+    return [task for task in tasks if task.name in selected]
+
+def plan(tasks, force=False):
+    # {task name: reason} for every task that has to run. tasks are in dependency order, so a task's deps are decided first
+    reasons = {}
+    for task in tasks:
+        ran_deps = [dep for dep in task.deps if dep in reasons]
+        if force and task.check is None:
+            reasons[task.name] = 'forced'
+        elif len(ran_deps) > 0:
+            reasons[task.name] = '{} runs first'.format(', '.join(ran_deps))
+        else:
+            reason = task.get_reason()
+            if reason is not None:
+                reasons[task.name] = reason
+    return reasons
+
+def run_task(step, city, source, args):
+    with instrumentation.stage('pipeline.' + step, city=city):
+        if step == 'download':
+            os.makedirs(get_city_dir(city), exist_ok=True)
+            command = [sys.executable, os.path.join(REPO_DIR, 'file-downloader.py'), source['url'], '-D', '--dir', get_city_dir(city), '--sync', '-x', '--extract-pattern', r'\.csv$',
+                '-m', '0', '-c', str(args.download_capacity), '-w', str(args.download_workers)]
+            if source.get('filename_pattern'):
+                command += ['-p', source['filename_pattern']]
+            subprocess.run(command + instrumentation.get_arguments(), check=True)
+        elif step == 'unzip':
+            from unzipper import extract_archive
+            for path in list_files(city, '.zip'):
+                extract_archive(path, get_city_dir(city), re.compile(r'\.csv$'), skip_existing=True)
+        elif step == 'merge':
+            from conversion_cache import ConversionCache
+            from merger import merge, merge_partitioned
+            cache = ConversionCache() if not args.no_cache else None
+            if args.partitioned:
+                merge_partitioned(PARTITION_DIR, args.merge_jobs, args.chunksize, args.distance, args.format, cache, args.distance_cache_dir, [city], args.csv_engine)
+            else:
+                merge(args.merge_jobs, args.chunksize, args.distance, False, args.format, cache, args.distance_cache_dir, [city], args.csv_engine)
+        elif step == 'update_weather':
+            from update_weather import update_weather_df
+            update_weather_df(source['weather'], city, args.format)
+        elif step == 'merge_weather':
+            # merge-weather.py can't be imported by name, so its --jobs workers couldn't unpickle its functions either
+            command = [sys.executable, os.path.join(REPO_DIR, 'merge-weather.py'), city, '--format', args.format, '--bss-dir', '.']
+            if args.partitioned:
+                command += ['--partitioned', '--output-dir', COMPLETE_PARTITION_DIR, '-j', str(args.merge_jobs)]
+            subprocess.run(command + instrumentation.get_arguments(), check=True)
+    return step, city
+
+def run_tasks(tasks, reasons, sources, jobs, args):
+    # runs the planned tasks, each as soon as the tasks it depends on are done. Returns the names of the failed ones
+    by_name = {task.name: task for task in tasks}
+    waiting = [task for task in tasks if task.name in reasons]
+    done = set([task.name for task in tasks if task.name not in reasons])
+    failed = set()
+
+    def take_ready():
+        ready = []
+        for task in list(waiting):
+            if any([dep in failed for dep in task.deps]):
+                print('[WARN] skipping {}, a task it depends on failed'.format(task.name))
+                failed.add(task.name)
+                waiting.remove(task)
+            elif all([dep in done or dep not in by_name for dep in task.deps]):
+                ready.append(task)
+                waiting.remove(task)
+        return ready
+
+    def finish(task, error):
+        if error is None:
+            done.add(task.name)
+        else:
+            print('[WARN] {} failed: {}'.format(task.name, error))
+            failed.add(task.name)
+
+    if jobs <= 1:
+        while len(waiting) > 0:
+            ready = take_ready()
+            if len(ready) == 0:
+                break
+            for task in ready:
+                print('[INFO] running {} ({})'.format(task.name, reasons[task.name]))
+                try:
+                    run_task(task.step, task.city, sources[task.city], args)
+                    finish(task, None)
+                except Exception as e:
+                    finish(task, e)
+        return failed
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while len(waiting) > 0 or len(running) > 0:
+            for task in take_ready():
+                print('[INFO] running {} ({})'.format(task.name, reasons[task.name]))
+                running[executor.submit(run_task, task.step, task.city, sources[task.city], args)] = task
+            finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in finished:
+                finish(running.pop(future), future.exception())
+    return failed
+
+def load_sources(config_path):
+    sources = {city: dict(source) for city, source in SOURCES.items()}
+    if config_path:
+        with open(config_path) as config_file:
+            for city, source in json.load(config_file).items():
+                sources.setdefault(city, {}).update(source)
+    return sources
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("steps", nargs="*", default=STEPS, help="Steps to bring up to date, out of {}. The steps they depend on run first when needed. Default is every step.".format(', '.join(STEPS)))
+    parser.add_argument("--dir", required=False, default=".", help="Data directory holding bss/{city}/, the weather files and every output. Default is the current directory.")
+    parser.add_argument("--cities", required=False, help="Comma-separated cities to run. Default is every city in the sources.")
+    parser.add_argument("--config", required=False, help="JSON file of city sources ({city: {url, filename_pattern, weather}}), merged into the defaults.")
+    parser.add_argument("--jobs", "-j", type=int, required=False, default=1, help="Number of tasks (e.g. different cities) run at the same time, each in its own process. Default is 1.")
+    parser.add_argument("--dry-run", "-n", required=False, action="store_true", default=False, help="Prints which tasks would run and why, without running them.")
+    parser.add_argument("--force", required=False, action="store_true", default=False, help="Runs every selected task, even if its outputs are up to date. Downloads still need --download.")
+    parser.add_argument("--download", required=False, action="store_true", default=False, help="Syncs every city that has a bucket url with its bucket. Otherwise cities are only downloaded once.")
+    parser.add_argument("--download-capacity", type=int, required=False, default=100000, help="Maximum number of MegaBytes downloaded per city. Default is %(default)s.")
+    parser.add_argument("--download-workers", type=int, required=False, default=4, help="Number of files of one city downloaded at the same time. Default is 4.")
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), required=False, default="csv", help="Format of every output. Default is csv.")
+    parser.add_argument("--distance", choices=sorted(DISTANCE_METHOD_NAMES), required=False, default="geodesic", help="How trip distances are computed, see merger.py. Default is geodesic.")
+    parser.add_argument("--chunksize", type=int, required=False, help="Converts each monthly csv this many rows at a time, see merger.py.")
+    parser.add_argument("--csv-engine", choices=CSV_ENGINES, required=False, default="c", help="Parser for the monthly csvs, see merger.py. Default is c.")
+    parser.add_argument("--merge-jobs", type=int, required=False, default=1, help="Number of monthly files (or, with --partitioned, weather partitions) of one city processed at the same time. Default is 1.")
+    parser.add_argument("--partitioned", required=False, action="store_true", default=False, help="Writes the merged and weather-joined trips as one file per city and month under {} and {}, see merger.py.".format(PARTITION_DIR, COMPLETE_PARTITION_DIR))
+    parser.add_argument("--no-cache", required=False, action="store_true", default=False, help="Converts every file again instead of reusing earlier conversions of unchanged files.")
+    parser.add_argument("--distance-cache-dir", required=False, help="Keeps station pair distances between runs, see merger.py.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    for step in args.steps:
+        if step not in STEPS:
+            parser.error('{} is not a valid step'.format(step))
+    if args.chunksize and args.csv_engine == 'pyarrow':
+        parser.error("--chunksize can't be used with --csv-engine pyarrow")
+    sources = load_sources(args.config)
+    cities = args.cities.split(',') if args.cities else list(sources.keys())
+    for city in cities:
+        if city not in sources:
+            parser.error('{} has no sources, add it with --config'.format(city))
+    if args.distance_cache_dir:
+        args.distance_cache_dir = os.path.abspath(args.distance_cache_dir)
+    instrumentation.configure_from_args(args) # before changing directory, so relative paths are from where this was run
+    os.chdir(args.dir)
+
+    tasks = select_tasks(get_tasks(cities, sources, args), args.steps)
+    reasons = plan(tasks, args.force)
+    for task in tasks:
+        print('{:>25} {}'.format(task.name, reasons.get(task.name, 'up to date')))
+    if args.dry_run or len(reasons) == 0:
+        sys.exit(0)
+    failed = run_tasks(tasks, reasons, sources, args.jobs, args)
+    instrumentation.finish()
+    if len(failed) > 0:
+        print('[WARN] {} of {} tasks failed: {}'.format(len(failed), len(reasons), ', '.join(sorted(failed))))
+        sys.exit(1)
@@ -0,0 +1,60 @@
+import random
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from tqdm import tqdm
+
+RETRYABLE_STATUS_CODES = set([429, 500, 502, 503, 504])
+
+# attempts counts the first try. The delay before retry k (0-based) is drawn uniformly from
+# [0, min(max_backoff, backoff * 2^k)] ("full jitter"), unless the server sent a Retry-After header.
+RetryPolicy = namedtuple('RetryPolicy', ['attempts', 'backoff', 'max_backoff'])
+NO_RETRIES = RetryPolicy(1, 0, 0)
+
+def get_status_code(error):
+    response = getattr(error, 'response', None)
+    return response.status_code if response is not None else None
+
+def is_retryable(error):
+    if isinstance(error, requests.HTTPError):
+        return get_status_code(error) in RETRYABLE_STATUS_CODES
+    # RuntimeError covers short reads and failed checks raised by the download code itself
+    return isinstance(error, (requests.RequestException, RuntimeError))
+
+def get_retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None or response.status_code not in (429, 503):
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def get_delay(policy, retry_index, error):
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        return min(retry_after, policy.max_backoff)
+    return random.uniform(0, min(policy.max_backoff, policy.backoff * 2 ** retry_index))
+
+def with_retries(policy, description, function, *args, on_retry=None):
+    for attempt in range(1, policy.attempts + 1):
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt == policy.attempts or not is_retryable(e):
+                e.attempts = attempt
+                raise
+            delay = get_delay(policy, attempt - 1, e)
+            tqdm.write("[WARN] attempt {}/{} failed for {}: {}. Retrying in {:.1f}s".format(attempt, policy.attempts, description, e, delay))
+            if on_retry is not None:
+                on_retry()
+            time.sleep(delay)
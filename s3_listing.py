@@ -0,0 +1,81 @@
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+import requests
+
+LISTING_TIMEOUT = 60 # seconds
+
+ObjectRecord = namedtuple('ObjectRecord', ['key', 'size', 'etag', 'last_modified'])
+
+def trim_xml_tag(tag):
+    right_bracket = tag.find("}")
+    return tag[right_bracket+1:]
+
+def record_from_contents(contents):
+    fields = {trim_xml_tag(child.tag): child.text for child in contents}
+    key = fields.get('Key') or ''
+    if len(key) == 0:
+        return None
+    size = int(fields['Size']) if fields.get('Size') else -1
+    etag = (fields.get('ETag') or '').strip('"')
+    return ObjectRecord(key, size, etag, fields.get('LastModified') or '')
+
+def iter_page_records(stream, page, common_prefixes=None):
+    # page collects the pagination fields (IsTruncated, NextMarker, NextContinuationToken) and the last key seen
+    root = None
+    try:
+        for event, elem in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            tag = trim_xml_tag(elem.tag)
+            if tag == 'Contents':
+                record = record_from_contents(elem)
+                root.clear() # drop parsed entries so a page never sits in memory as a whole
+                if record is not None:
+                    page['LastKey'] = record.key
+                    yield record
+            elif tag == 'CommonPrefixes':
+                prefix = ''.join([child.text or '' for child in elem if trim_xml_tag(child.tag) == 'Prefix'])
+                page['LastPrefix'] = prefix
+                if common_prefixes is not None:
+                    common_prefixes.append(prefix)
+                root.clear()
+            elif tag in ('IsTruncated', 'NextMarker', 'NextContinuationToken'):
+                page[tag] = elem.text
+    except ET.ParseError:
+        raise RuntimeError("Couldn't parse the URL content as XML")
+
+def list_bucket(url, prefix=None, delimiter=None, list_type=1, session=None, common_prefixes=None):
+    if list_type not in (1, 2):
+        raise ValueError('{} is not a valid ListObjects version'.format(list_type))
+    params = {}
+    if list_type == 2:
+        params['list-type'] = 2
+    if prefix:
+        params['prefix'] = prefix
+    if delimiter:
+        params['delimiter'] = delimiter
+    session = session if session is not None else requests.Session()
+
+    while True:
+        with session.get(url, params=params, stream=True, timeout=LISTING_TIMEOUT) as response:
+            if response.status_code != 200:
+                raise RuntimeError("HTTP GET status code: {}".format(response.status_code))
+            response.raw.decode_content = True
+            page = {}
+            yield from iter_page_records(response.raw, page, common_prefixes)
+
+        if (page.get('IsTruncated') or 'false').lower() != 'true':
+            return
+        if list_type == 2:
+            if not page.get('NextContinuationToken'):
+                raise RuntimeError("Listing is truncated but has no NextContinuationToken")
+            params['continuation-token'] = page['NextContinuationToken']
+        else:
+            # NextMarker is only sent when a delimiter is used. Otherwise the next page starts after the last key
+            marker = page.get('NextMarker') or max(page.get('LastKey', ''), page.get('LastPrefix', ''))
+            if not marker:
+                raise RuntimeError("Listing is truncated but has no marker to continue from")
+            params['marker'] = marker
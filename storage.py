@@ -0,0 +1,72 @@
+import os
+import pandas as pd
+
+from column_conversions import apply_final_dtypes
+from constants import FORMATS
+
+# csv keeps the original text output. parquet and feather store typed columns (see FINAL_DTYPES in column_conversions.py)
+# and need pyarrow installed.
+
+def get_path(stem, file_format):
+    if file_format not in FORMATS:
+        raise ValueError('{} is not a valid format'.format(file_format))
+    return stem + FORMATS[file_format]
+
+def find_input(stem, file_format=None):
+    # the file in file_format if there is one, otherwise the most recently written format, so a leftover file from a
+    # run in another format isn't read instead of the current one
+    if file_format is not None and os.path.isfile(get_path(stem, file_format)):
+        return get_path(stem, file_format)
+    paths = [get_path(stem, file_format) for file_format in FORMATS.keys() if os.path.isfile(get_path(stem, file_format))]
+    if len(paths) == 0:
+        raise FileNotFoundError('No {} file found for {}'.format('/'.join(FORMATS.keys()), stem))
+    return max(paths, key=os.path.getmtime)
+
+def read_frame(path, columns=None):
+    if path.endswith(FORMATS['parquet']):
+        return pd.read_parquet(path, columns=columns)
+    if path.endswith(FORMATS['feather']):
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+def write_frame(df, path, apply_dtypes=apply_final_dtypes):
+    if path.endswith(FORMATS['parquet']):
+        apply_dtypes(df).to_parquet(path, index=False)
+    elif path.endswith(FORMATS['feather']):
+        apply_dtypes(df).reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path)
+
+class FrameWriter():
+    # appends frames to one output as they come in, so no more than one file (or chunk) has to be in memory.
+    # feather files can't be appended to, so feather frames are kept until close()
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.row_count = 0
+        self.parquet_writer = None
+        self.feather_frames = []
+
+    def write(self, df):
+        if self.path.endswith(FORMATS['parquet']):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.parquet_writer is None:
+                table = pa.Table.from_pandas(apply_final_dtypes(df), preserve_index=False)
+                self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            else:
+                table = pa.Table.from_pandas(apply_final_dtypes(df), schema=self.parquet_writer.schema, preserve_index=False)
+            self.parquet_writer.write_table(table)
+        elif self.path.endswith(FORMATS['feather']):
+            self.feather_frames.append(apply_final_dtypes(df))
+        else:
+            df.to_csv(self.path, mode='a' if self.row_count > 0 else 'w', header=self.row_count == 0)
+        self.row_count += len(df)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+        if len(self.feather_frames) > 0:
+            pd.concat(self.feather_frames, ignore_index=True).to_feather(self.path)
+            self.feather_frames = []
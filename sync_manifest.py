@@ -0,0 +1,48 @@
+import json
+import os
+
+MANIFEST_FILENAME = '.bucket-manifest.jsonl' # kept in the download directory
+
+# The manifest is a JSON-lines log with one entry per downloaded key. Later lines win, so entries can be appended
+# as soon as each download finishes and an interrupted run still keeps what it already fetched.
+def load_manifest(path=MANIFEST_FILENAME):
+    manifest = {}
+    if not os.path.isfile(path):
+        return manifest
+    with open(path) as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                print("[WARN] skipping unreadable manifest line: {}".format(line))
+                continue
+            manifest[entry['key']] = entry
+    return manifest
+
+def manifest_entry(record, filename):
+    return {'key': record.key, 'etag': record.etag, 'size': record.size, 'last_modified': record.last_modified, 'filename': filename}
+
+def append_manifest_entries(entries, path=MANIFEST_FILENAME):
+    with open(path, 'a') as manifest_file:
+        for entry in entries:
+            manifest_file.write(json.dumps(entry) + '\n')
+
+def save_manifest(manifest, path=MANIFEST_FILENAME):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as manifest_file:
+        for key in sorted(manifest.keys()):
+            manifest_file.write(json.dumps(manifest[key]) + '\n')
+    os.replace(temp_path, path)
+
+def is_up_to_date(record, entry, directory='.'):
+    if entry is None:
+        return False
+    if (entry['etag'], entry['size'], entry['last_modified']) != (record.etag, record.size, record.last_modified):
+        return False
+    if entry.get('extracted'):
+        return True
+    path = os.path.join(directory, entry['filename'])
+    return os.path.isfile(path) and os.path.getsize(path) == record.size
@@ -1,18 +1,90 @@
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fnmatch
 import os
+import re
 import zipfile
+import zlib
 from tqdm import tqdm
+import instrumentation
 
-parser = ArgumentParser()
-parser.add_argument("dir") 
-args = parser.parse_args()
+CRC_BUFFER_SIZE = 1024 * 1024
 
-with os.scandir(args.dir) as files:
-    for file in tqdm(sorted(files, key=lambda file: file.name)):
-        if file.name.endswith(".zip") and file.is_file():
+def glob_to_regex(pattern):
+    return re.compile('^' + fnmatch.translate(pattern))
+
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(CRC_BUFFER_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+def check_member(zip_ref, info):
+    # reads the member through, which makes zipfile check its CRC-32
+    with zip_ref.open(info) as member:
+        while member.read(CRC_BUFFER_SIZE):
+            pass
+
+def is_extracted(info, target, check_crc):
+    if not os.path.isfile(target) or os.path.getsize(target) != info.file_size:
+        return False
+    return not check_crc or file_crc32(target) == info.CRC
+
+# zipfile checks each member's CRC-32 while extracting it and raises BadZipFile on a mismatch, so once every member
+# is extracted (or already on disk and matching) the archive is known to be good and can be removed. A member already
+# on disk is only skipped on a matching size when the archive is kept: before removing the archive, the file on disk
+# has to match its CRC-32 too, or it's extracted again, since the archive is the only good copy. Members left out by
+# member_regex are read through to check their CRC-32 before the archive is removed as well.
+def extract_archive(path, directory, member_regex=None, remove=True, skip_existing=False, check_crc=False):
+    check_crc = check_crc or remove
+    extracted = []
+    with instrumentation.stage('extract', archive=os.path.basename(path)) as extract_stage:
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            unchecked = []
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                if member_regex is not None and member_regex.search(info.filename) is None:
+                    unchecked.append(info)
+                    continue
+                if skip_existing and is_extracted(info, os.path.join(directory, info.filename), check_crc):
+                    continue
+                zip_ref.extract(info, directory)
+                extracted.append(info.filename)
+                extract_stage.add(rows=1, bytes=info.file_size)
+            if remove:
+                for info in unchecked:
+                    check_member(zip_ref, info)
+        if remove:
+            os.remove(path)
+    return extracted
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("dir")
+    parser.add_argument("--jobs", "-j", type=int, required=False, default=1, help="Number of archives extracted at the same time, each in its own process. Default is 1.")
+    parser.add_argument("--members", required=False, help="Regular expression for archive members to extract (e.g. '\\.csv$'). Default is every member.")
+    parser.add_argument("--members-glob", required=False, help="Glob pattern for archive members to extract (e.g. '*.csv'). Used instead of --members.")
+    parser.add_argument("--overwrite", required=False, action="store_true", default=False, help="Extracts every member again, even if a file of the same size is already there.")
+    parser.add_argument("--check-crc", required=False, action="store_true", default=False, help="Only skips members already on disk if their CRC-32 matches the archive, not just their size. Always on unless --keep is given.")
+    parser.add_argument("--keep", required=False, action="store_true", default=False, help="Keeps archives after extracting them.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    if args.members_glob:
+        member_regex = glob_to_regex(args.members_glob)
+    else:
+        member_regex = re.compile(args.members) if args.members else None
+
+    with os.scandir(args.dir) as files:
+        archives = sorted([file.path for file in files if file.name.endswith(".zip") and file.is_file()])
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(extract_archive, path, args.dir, member_regex, not args.keep, not args.overwrite, args.check_crc): path for path in archives}
+        for future in tqdm(as_completed(futures), total=len(futures)):
             try:
-                with zipfile.ZipFile(file.path, 'r') as zip_ref:
-                    zip_ref.extractall(args.dir)
-                    os.remove(file.path)
+                future.result()
             except Exception as e:
-                print("Encountered exception while downloading {}: {}".format(file.name, e))
\ No newline at end of file
+                print("Encountered exception while extracting {}: {}".format(os.path.basename(futures[future]), e))
+    instrumentation.finish()
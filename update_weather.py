@@ -1,7 +1,13 @@
+from argparse import ArgumentParser
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
 from datetime import datetime
 from collections import Counter
+from constants import FORMATS
+from storage import get_path, write_frame
+import instrumentation
 
 HOURLY_COLUMNS = [
     'HourlyDewPointTemperature',
@@ -30,23 +36,61 @@ WEATHER_CODES = {
 WEATHER_COLUMNS = ['DATE'] + HOURLY_COLUMNS + list(WEATHER_CODES.keys())
 START_DATE = '2018-02-01T00:00:00'
 END_DATE = '2020-01-01T00:00:00'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+WEATHER_CODE_DTYPE = pd.CategoricalDtype(['Yes', 'No']) # '' (no codes reported) is stored as missing, like it reads back from csv
 
-def update_weather_df(filename, city):
-    df = pd.read_csv(filename)
-    df = df.sort_values('DATE')
-    df = df[df['DATE'] >= START_DATE]
-    df = df[df['DATE'] < END_DATE]
-    df['aw_codes'] = df.HourlyPresentWeatherType.apply(lambda weather_type: str(weather_type).split('|')[0])
-    df['aw_codes'] = df.aw_codes.apply(lambda codes: '' if codes == 'nan' else codes)
-    for col_name, code in WEATHER_CODES.items():
-        df[col_name] = df.aw_codes.apply(lambda codes_string: '' if len(codes_string) == 0 else 'Yes' if code in codes_string else 'No')
-    df['rain'] = df.aw_codes.apply(lambda codes_string: '' if len(codes_string) == 0 else 'Yes' if 'RA' in codes_string and '+RA' not in codes_string and '-RA' not in codes_string else 'No')
-    df = df[WEATHER_COLUMNS]
-    df.to_csv('{}-updated-weather.csv'.format(city))
+def apply_weather_dtypes(df):
+    df = df.copy()
+    if 'DATE' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['DATE']):
+        df['DATE'] = pd.to_datetime(df['DATE'], format=DATE_FORMAT)
+    for col_name in WEATHER_CODES.keys():
+        if col_name in df.columns:
+            df[col_name] = df[col_name].where(df[col_name] != '').astype(WEATHER_CODE_DTYPE)
+    return df
+
+def get_code_indicators(aw_codes):
+    # '' when no codes were reported, otherwise 'Yes'/'No' for every weather type. 'rain' only counts RA that isn't +RA or -RA
+    if len(aw_codes) == 0:
+        return {col_name: '' for col_name in WEATHER_CODES.keys()}
+    indicators = {col_name: 'Yes' if code in aw_codes else 'No' for col_name, code in WEATHER_CODES.items()}
+    indicators['rain'] = 'Yes' if 'RA' in aw_codes and '+RA' not in aw_codes and '-RA' not in aw_codes else 'No'
+    return indicators
+
+def add_weather_codes(df):
+    # A station reports only a few hundred distinct HourlyPresentWeatherType strings over years of hourly rows, so the codes
+    # are worked out once per distinct string and spread back to every row with a single take per column
+    positions, present_weather_types = pd.factorize(df.HourlyPresentWeatherType)
+    aw_codes = [str(weather_type).split('|')[0] for weather_type in present_weather_types] + [''] # position -1 is a missing value
+    aw_codes = ['' if codes == 'nan' else codes for codes in aw_codes]
+    indicators = pd.DataFrame([get_code_indicators(codes) for codes in aw_codes], columns=list(WEATHER_CODES.keys()))
+    df = df.copy()
+    for col_name in WEATHER_CODES.keys():
+        df[col_name] = indicators[col_name].to_numpy()[positions]
+    return df
+
+def update_weather_df(filename, city, output_format='csv'):
+    with instrumentation.stage('update_weather', city=city) as weather_stage:
+        with instrumentation.stage('update_weather.read', city=city) as read_stage:
+            # only the columns that are kept are read. LCD files have well over a hundred
+            df = pd.read_csv(filename, usecols=['DATE'] + HOURLY_COLUMNS + ['HourlyPresentWeatherType'], low_memory=False)
+            read_stage.add(rows=len(df), bytes=os.path.getsize(filename))
+        df = df[(df['DATE'] >= START_DATE) & (df['DATE'] < END_DATE)]
+        df = df.sort_values('DATE', kind='stable') # rows with the same DATE keep their order in the file
+        with instrumentation.stage('update_weather.codes', city=city) as codes_stage:
+            df = add_weather_codes(df)
+            codes_stage.add(rows=len(df))
+        df = df[WEATHER_COLUMNS]
+        with instrumentation.stage('update_weather.write', city=city, format=output_format):
+            write_frame(df, get_path('{}-updated-weather'.format(city), output_format), apply_weather_dtypes)
+        weather_stage.add(rows=len(df))
     for weather_type in WEATHER_CODES.keys():
-        print('{}: {}'.format(weather_type, Counter(df[weather_type])))
+        print('{}: {}'.format(weather_type, Counter({value: int(count) for value, count in df[weather_type].value_counts().items()})))
     return df
 
+def update_station(city, filename, output_format):
+    update_weather_df(filename, city, output_format)
+    return city
+
 # boston_weather = update_weather_df('./weather/boston-weather.csv', 'boston')
 # nyc_weather = update_weather_df('./weather/nyc-weather-laguardia-airport.csv', 'nyc')
 # columbus_weather = update_weather_df('./weather/columbus-weather-john-glen-airport.csv', 'columbus')
@@ -55,3 +99,26 @@ def update_weather_df(filename, city):
 
 # dc_weather = update_weather_df('./weather/dc-weather-washington-reagan-airport-arlington-va.csv')
 # sf_weather = update_weather_df('./weather/sf-weather-downtown.csv', 'sf')
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("stations", nargs="+", help="One CITY=FILE pair per station file, e.g. nyc=./weather/nyc-weather-laguardia-airport.csv")
+    parser.add_argument("--format", choices=sorted(FORMATS.keys()), required=False, default="csv", help="Output format of {city}-updated-weather. Default is csv.")
+    parser.add_argument("--jobs", "-j", type=int, required=False, default=1, help="Number of station files processed at the same time, each in its own process. Default is 1.")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+    stations = []
+    for station in args.stations:
+        if '=' not in station:
+            parser.error('{} is not a CITY=FILE pair'.format(station))
+        stations.append(station.split('=', 1))
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(update_station, city, filename, args.format): filename for city, filename in stations}
+        for future in as_completed(futures):
+            try:
+                print('Finished weather for {}'.format(future.result()))
+            except Exception as e:
+                print("[WARN] Encountered exception while processing {}: {}".format(futures[future], e))
+    instrumentation.finish()